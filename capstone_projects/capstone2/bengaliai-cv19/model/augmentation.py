@@ -0,0 +1,159 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+import numpy as np
+
+
+def draw_transforms(rng, n, height, width, rotation_range, width_shift_range, height_shift_range):
+    """
+    Draws the random rotation and shifts of n images from rng, with the same ranges and meaning as
+    ImageDataGenerator.get_random_transform, as one array per parameter
+
+    Returns:
+        theta - Rotation angles in degrees
+        tx - Shifts along the rows (vertical), in pixels
+        ty - Shifts along the columns (horizontal), in pixels
+
+    """
+    height_shift = height_shift_range
+    width_shift = width_shift_range
+    if height_shift < 1:
+        height_shift *= height
+    if width_shift < 1:
+        width_shift *= width
+    theta = rng.uniform(-rotation_range, rotation_range, n)
+    tx = rng.uniform(-height_shift, height_shift, n)
+    ty = rng.uniform(-width_shift, width_shift, n)
+    return theta, tx, ty
+
+
+def affine_matrices(theta, tx, ty, height, width):
+    """
+    Composes the rotation and shift of every image into a single 2x3 affine matrix, the way
+    keras' apply_affine_transform does (rotation about the centre of the image after the shift).
+    The matrices map each output pixel (x, y) to the input pixel it is read from, so they are
+    meant for cv2.warpAffine with WARP_INVERSE_MAP
+
+    Arguments:
+        theta, tx, ty - Arrays from draw_transforms
+        height, width - Size of the images
+
+    Returns:
+        matrices - float64 array of shape (n_images, 2, 3)
+
+    """
+    theta = np.deg2rad(theta)
+    cos, sin = np.cos(theta), np.sin(theta)
+    # keras works in (row, column) coordinates around this centre, cv2 in (column, row) ones
+    cx, cy = width / 2 + 0.5, height / 2 + 0.5
+    matrices = np.empty((len(theta), 2, 3))
+    matrices[:, 0, 0] = cos
+    matrices[:, 0, 1] = sin
+    matrices[:, 0, 2] = cx - cos * cx + cos * ty - sin * cy + sin * tx
+    matrices[:, 1, 0] = -sin
+    matrices[:, 1, 1] = cos
+    matrices[:, 1, 2] = cy - cos * cy + cos * tx + sin * cx - sin * ty
+    return matrices
+
+
+def _warp_range(images, matrices, out, start, stop):
+    height, width = images.shape[1], images.shape[2]
+    for j in range(start, stop):
+        warped = cv2.warpAffine(
+            images[j],
+            matrices[j],
+            (width, height),
+            flags=cv2.INTER_LINEAR | cv2.WARP_INVERSE_MAP,
+            borderMode=cv2.BORDER_REPLICATE,
+        )
+        # cv2 drops the channel axis of single channel images
+        out[j] = warped.reshape(out.shape[1:])
+
+
+def warp_batch(images, matrices, out=None, n_jobs=1):
+    """
+    Applies one affine matrix to each image of a batch with cv2.warpAffine, using bilinear
+    interpolation and repeating the edge pixels outside the image like ImageDataGenerator's default
+    fill_mode="nearest". As in image_processor_func, the batch is split into one contiguous range
+    per thread
+
+    Arguments:
+        images - Array of shape (n_images, height, width) or (n_images, height, width, channels)
+        matrices - Array of shape (n_images, 2, 3) from affine_matrices
+        out - Optional array of the same shape to write to, which can be images itself
+        n_jobs - Number of worker threads, defaults to the number of cores
+
+    Returns:
+        out - The transformed images, with the dtype of out (or of images)
+
+    """
+    if out is None:
+        out = np.empty_like(images)
+    n_images = len(images)
+    if n_jobs is None:
+        n_jobs = os.cpu_count() or 1
+    n_jobs = max(1, min(n_jobs, n_images))
+
+    if n_jobs == 1:
+        _warp_range(images, matrices, out, 0, n_images)
+        return out
+    bounds = np.linspace(0, n_images, n_jobs + 1).astype(int)
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        futures = [
+            executor.submit(_warp_range, images, matrices, out, bounds[k], bounds[k + 1])
+            for k in range(n_jobs)
+        ]
+        for future in futures:
+            future.result()
+    return out
+
+
+class BatchAugmenter:
+    """
+    Random rotation and shift augmentation of whole batches. The parameters of every image of a
+    batch are drawn at once, composed into one affine matrix per image and applied by warp_batch,
+    instead of going through ImageDataGenerator.apply_transform one image at a time. All the
+    randomness comes from the RandomState passed to augment, so a batch can be reproduced from
+    the seed of its stream
+
+    Arguments:
+        rotation_range, width_shift_range, height_shift_range - Same meaning as in ImageDataGenerator
+        n_jobs - Number of threads warping each batch
+
+    """
+
+    def __init__(self, rotation_range=0, width_shift_range=0.0, height_shift_range=0.0, n_jobs=1):
+        self.rotation_range = rotation_range
+        self.width_shift_range = width_shift_range
+        self.height_shift_range = height_shift_range
+        self.n_jobs = n_jobs
+
+    @property
+    def enabled(self):
+        return bool(self.rotation_range or self.width_shift_range or self.height_shift_range)
+
+    def augment(self, images, rng, out=None):
+        """
+        Randomly rotates and shifts a batch of images, in place if out is images
+
+        Arguments:
+            images - Array of shape (n_images, height, width, channels)
+            rng - np.random.RandomState to draw the parameters from
+            out - Optional array to write the augmented images to
+
+        Returns:
+            out - The augmented images
+
+        """
+        height, width = images.shape[1], images.shape[2]
+        theta, tx, ty = draw_transforms(
+            rng,
+            len(images),
+            height,
+            width,
+            self.rotation_range,
+            self.width_shift_range,
+            self.height_shift_range,
+        )
+        matrices = affine_matrices(theta, tx, ty, height, width)
+        return warp_batch(images, matrices, out=out, n_jobs=self.n_jobs)
@@ -1,8 +1,23 @@
+import threading
 import numpy as np
 import keras
+from augmentation import BatchAugmenter
+from instrumentation import StageProfiler
 
 
 class MultiOutputDataGenerator(keras.preprocessing.image.ImageDataGenerator):
+    """
+    ImageDataGenerator whose flow yields a dictionary of targets per output. The rotation and
+    shifts aren't applied image by image by keras, but to each whole batch by a BatchAugmenter,
+    after the other transforms and the standardization
+    """
+
+    def get_random_transform(self, img_shape, seed=None):
+        params = super().get_random_transform(img_shape, seed)
+        # rotation and shifts are left to the batch augmenter of flow
+        params.update(theta=0, tx=0, ty=0)
+        return params
+
     def flow(
         self,
         x,
@@ -21,15 +36,24 @@ class MultiOutputDataGenerator(keras.preprocessing.image.ImageDataGenerator):
         target_lengths = {}
         ordered_outputs = []
         for output, target in y.items():
+            # integer class ids come in as 1D arrays, so we give them a column axis to concatenate on
+            if target.ndim == 1:
+                target = target.reshape(-1, 1)
             if targets is None:
                 targets = target
             else:
                 targets = np.concatenate((targets, target), axis=1)
             target_lengths[output] = target.shape[1]
             ordered_outputs.append(output)
+        augmenter = BatchAugmenter(
+            self.rotation_range, self.width_shift_range, self.height_shift_range
+        )
+        rng = np.random.RandomState(seed)
         for flowx, flowy in super().flow(
-            x, targets, batch_size=batch_size, shuffle=shuffle
+            x, targets, batch_size=batch_size, shuffle=shuffle, seed=seed
         ):
+            if augmenter.enabled:
+                augmenter.augment(flowx, rng, out=flowx)
             target_dict = {}
             i = 0
             for output in ordered_outputs:
@@ -38,3 +62,205 @@ class MultiOutputDataGenerator(keras.preprocessing.image.ImageDataGenerator):
                 i += target_length
 
             yield flowx, target_dict
+
+
+class MultiOutputSequence(keras.utils.Sequence):
+    """
+    Sequence based replacement for MultiOutputDataGenerator. Batches are gathered straight from
+    the image array and the integer label arrays by index, with no concatenating and re-slicing
+    of the targets, and are written into preallocated buffers which are reused round robin.
+
+    Each batch only depends on its index and the epoch, including the random augmentation, so it is
+    safe to use with workers > 1 and use_multiprocessing in fit_generator. Enough buffers are kept
+    (max_queue_size + workers + 2) that a batch is never overwritten while it still waits in the queue
+
+    Arguments:
+        x - Image array of shape (n_images, height, width, 1), uint8 or memory-mapped
+        y - Dictionary of output name to integer label array
+        batch_size - Number of images per batch
+        shuffle - Reshuffle the images at the end of each epoch
+        seed - Seed for shuffling and augmentation
+        rotation_range, width_shift_range, height_shift_range - Same meaning as in ImageDataGenerator
+        indices - Rows of x to use, all of them by default
+        max_queue_size, workers - The values passed to fit_generator
+        profiler - Optional StageProfiler which times the augmentation of each batch
+        augment_jobs - Number of threads warping each batch, on top of the keras workers
+        normalize - Scale each batch to [0, 1] as float32, for uint8 images and models created
+            without rescale_input
+
+    """
+
+    def __init__(
+        self,
+        x,
+        y,
+        batch_size=32,
+        shuffle=True,
+        seed=None,
+        rotation_range=0,
+        width_shift_range=0.0,
+        height_shift_range=0.0,
+        indices=None,
+        max_queue_size=10,
+        workers=1,
+        profiler=None,
+        augment_jobs=1,
+        normalize=False,
+    ):
+        self.x = x
+        self.y = y
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.seed = np.random.randint(2 ** 31) if seed is None else seed
+        self.augmenter = BatchAugmenter(
+            rotation_range, width_shift_range, height_shift_range, n_jobs=augment_jobs
+        )
+        self.normalize = normalize
+        self.indices = np.arange(len(x)) if indices is None else np.asarray(indices)
+        self.n_buffers = max_queue_size + workers + 2
+        self.profiler = profiler if profiler is not None else StageProfiler(enabled=False)
+        self.epoch = 0
+        self.order = self.indices
+        self._shuffle_order()
+        self._init_buffers()
+
+    def _init_buffers(self):
+        self._lock = threading.Lock()
+        self._next_buffer = 0
+        self._x_buffers = np.empty(
+            (self.n_buffers, self.batch_size) + self.x.shape[1:],
+            dtype=np.float32 if self.normalize else self.x.dtype,
+        )
+        self._y_buffers = {
+            output: np.empty(
+                (self.n_buffers, self.batch_size) + target.shape[1:], dtype=target.dtype
+            )
+            for output, target in self.y.items()
+        }
+
+    def __getstate__(self):
+        # locks can't be pickled, and there is no point in sending empty buffers to other processes
+        state = self.__dict__.copy()
+        for key in ["_lock", "_next_buffer", "_x_buffers", "_y_buffers"]:
+            del state[key]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_buffers()
+
+    def _shuffle_order(self):
+        if self.shuffle:
+            rng = np.random.RandomState([self.seed, self.epoch])
+            self.order = self.indices[rng.permutation(len(self.indices))]
+
+    def __len__(self):
+        return int(np.ceil(len(self.indices) / self.batch_size))
+
+    def __getitem__(self, index):
+        batch_indices = self.order[index * self.batch_size : (index + 1) * self.batch_size]
+        n = len(batch_indices)
+
+        # picking the next free buffer
+        with self._lock:
+            buffer = self._next_buffer
+            self._next_buffer = (self._next_buffer + 1) % self.n_buffers
+
+        batch_x = self._x_buffers[buffer, :n]
+        batch_y = {output: self._y_buffers[output][buffer, :n] for output in self.y}
+        self._gather(batch_indices, batch_x, batch_y)
+        if self.augmenter.enabled:
+            # every batch has its own random stream, so it doesn't matter which worker builds it
+            rng = np.random.RandomState([self.seed, self.epoch, index])
+            with self.profiler.stage("augmentation"):
+                self.augmenter.augment(batch_x, rng, out=batch_x)
+        if self.normalize:
+            with self.profiler.stage("normalization"):
+                np.multiply(batch_x, 1 / 255, out=batch_x)
+
+        return batch_x, batch_y
+
+    def _gather(self, batch_indices, batch_x, batch_y):
+        # copies the rows of the batch straight into its buffers
+        if batch_x.dtype == self.x.dtype:
+            np.take(self.x, batch_indices, axis=0, out=batch_x)
+        else:
+            # np.take can't convert the images as it copies them
+            batch_x[...] = self.x[batch_indices]
+        for output, target in self.y.items():
+            np.take(target, batch_indices, axis=0, out=batch_y[output])
+
+    def on_epoch_end(self):
+        self.epoch += 1
+        self._shuffle_order()
+
+
+# column of each output in the (n_images, 3) targets of a cached shard
+SHARD_TARGET_COLUMNS = {"output_root": 0, "output_vowel": 1, "output_consonant": 2}
+
+
+class MultiShardSequence(MultiOutputSequence):
+    """
+    MultiOutputSequence over several shards at once, so that an epoch is a single pass over
+    every parquet file. The training rows of all the shards are shuffled together every epoch and
+    each batch is gathered from whichever shards its images are in, which works well with the
+    memory-mapped shards of the cache. Callbacks such as early stopping then follow one continuous
+    training history instead of starting over on every file
+
+    Arguments:
+        shards - List of (images, int16 targets, training rows) as returned by
+            data_loader.load_cached_split
+        Other arguments - Same as in MultiOutputSequence
+
+    """
+
+    def __init__(
+        self,
+        shards,
+        batch_size=32,
+        shuffle=True,
+        seed=None,
+        rotation_range=0,
+        width_shift_range=0.0,
+        height_shift_range=0.0,
+        max_queue_size=10,
+        workers=1,
+        profiler=None,
+        augment_jobs=1,
+        normalize=False,
+    ):
+        self.shards = shards
+        # every training image is known by its shard and its row in that shard
+        self.shard_ids = np.concatenate(
+            [np.full(len(rows), k, dtype=np.int32) for k, (_, _, rows) in enumerate(shards)]
+        )
+        self.shard_rows = np.concatenate([rows for _, _, rows in shards])
+        x, y, _ = shards[0]
+        super(MultiShardSequence, self).__init__(
+            x,
+            {output: y[:, column] for output, column in SHARD_TARGET_COLUMNS.items()},
+            batch_size=batch_size,
+            shuffle=shuffle,
+            seed=seed,
+            rotation_range=rotation_range,
+            width_shift_range=width_shift_range,
+            height_shift_range=height_shift_range,
+            indices=np.arange(len(self.shard_rows)),
+            max_queue_size=max_queue_size,
+            workers=workers,
+            profiler=profiler,
+            augment_jobs=augment_jobs,
+            normalize=normalize,
+        )
+
+    def _gather(self, batch_indices, batch_x, batch_y):
+        batch_shards = self.shard_ids[batch_indices]
+        batch_rows = self.shard_rows[batch_indices]
+        for k in np.unique(batch_shards):
+            in_shard = np.flatnonzero(batch_shards == k)
+            rows = batch_rows[in_shard]
+            x, y, _ = self.shards[k]
+            batch_x[in_shard] = x[rows]
+            targets = y[rows]
+            for output, column in SHARD_TARGET_COLUMNS.items():
+                batch_y[output][in_shard] = targets[:, column]
@@ -0,0 +1,386 @@
+"""
+Benchmarks for the preprocessing and inference pipeline on synthetic data.
+
+Writes synthetic 137x236 parquet shards (and a matching train.csv), times each stage in a fresh
+process so its peak memory can be measured on its own, and saves the results to a json file which
+later runs can be compared against. Everything runs offline on the CPU
+
+Usage (from the project folder):
+    python model/benchmark.py --images 2000 --output benchmark.json
+    python model/benchmark.py --images 2000 --baseline benchmark.json
+"""
+import os
+import sys
+import json
+import time
+import glob
+import argparse
+import platform
+import resource
+import multiprocessing
+from queue import Empty
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import cv2
+
+HEIGHT = 137
+WIDTH = 236
+
+
+def _synthetic_images(n_images, rng):
+    """
+    Draws images which look roughly like the competition data: a light, slightly noisy background
+    with a few thick dark strokes in the middle of the canvas
+    """
+    images = rng.randint(235, 256, size=(n_images, HEIGHT, WIDTH)).astype(np.uint8)
+    for image in images:
+        for _ in range(rng.randint(3, 8)):
+            start = (rng.randint(40, WIDTH - 40), rng.randint(20, HEIGHT - 20))
+            end = (rng.randint(40, WIDTH - 40), rng.randint(20, HEIGHT - 20))
+            cv2.line(image, start, end, int(rng.randint(0, 60)), int(rng.randint(3, 9)))
+    return images
+
+
+def _write_shard(path, image_ids, images, row_group_size):
+    # building the table column by column avoids a 32k column pandas dataframe
+    flat = images.reshape(len(images), -1)
+    arrays = [pa.array(image_ids)] + [pa.array(flat[:, j]) for j in range(flat.shape[1])]
+    names = ["image_id"] + [str(j) for j in range(flat.shape[1])]
+    pq.write_table(
+        pa.Table.from_arrays(arrays, names=names), path, row_group_size=row_group_size
+    )
+
+
+def make_synthetic_shards(
+    data_dir, n_shards=1, images_per_shard=1000, seed=42, row_group_size=1000
+):
+    """
+    Writes train_image_data_{i}.parquet and test_image_data_{i}.parquet files along with a
+    train.csv of random labels to data_dir, in the same layout as the competition data. Shards
+    left over from earlier settings are removed first, since the stages glob every shard
+
+    Arguments:
+        data_dir - Folder to write the files to
+        n_shards - Number of train (and test) parquet files
+        images_per_shard - Number of images in each parquet file
+        seed - Seed of the random images and labels
+        row_group_size - Number of images per parquet row group
+
+    """
+    os.makedirs(data_dir, exist_ok=True)
+    for pattern in ["train_image_data_*.parquet", "test_image_data_*.parquet"]:
+        for path in glob.glob(os.path.join(data_dir, pattern)):
+            os.remove(path)
+    rng = np.random.RandomState(seed)
+    train_ids = []
+    for i in range(n_shards):
+        for prefix in ["Train", "Test"]:
+            image_ids = [
+                "{}_{}".format(prefix, i * images_per_shard + k)
+                for k in range(images_per_shard)
+            ]
+            path = os.path.join(
+                data_dir, "{}_image_data_{}.parquet".format(prefix.lower(), i)
+            )
+            _write_shard(
+                path,
+                image_ids,
+                _synthetic_images(images_per_shard, rng),
+                row_group_size,
+            )
+            if prefix == "Train":
+                train_ids.extend(image_ids)
+
+    n_images = len(train_ids)
+    pd.DataFrame(
+        {
+            "image_id": train_ids,
+            "grapheme_root": rng.randint(0, 168, n_images),
+            "vowel_diacritic": rng.randint(0, 11, n_images),
+            "consonant_diacritic": rng.randint(0, 7, n_images),
+            "grapheme": "",
+        }
+    ).to_csv(os.path.join(data_dir, "train.csv"), index=False)
+
+
+def _train_shards(data_dir):
+    return sorted(glob.glob(os.path.join(data_dir, "train_image_data_*.parquet")))
+
+
+def stage_data_loader(data_dir):
+    from data_loader import data_loader
+
+    train_df = pd.read_csv(os.path.join(data_dir, "train.csv"))
+    n_images = 0
+    for path in _train_shards(data_dir):
+        result = data_loader(path, train_df)
+        n_images += len(result[0]) + len(result[1])
+    return n_images
+
+
+def stage_data_loader_streaming(data_dir):
+    from data_loader import data_loader_streaming
+
+    train_df = pd.read_csv(os.path.join(data_dir, "train.csv"))
+    n_images = 0
+    for path in _train_shards(data_dir):
+        for image_ids, _, _, _, _ in data_loader_streaming(path, train_df):
+            n_images += len(image_ids)
+    return n_images
+
+
+def stage_image_processor(data_dir):
+    from data_loader import iter_parquet_blocks
+    from image_processor import image_processor_func
+
+    # the parquet files are read up front so only the processing itself is timed
+    blocks = [
+        pixels
+        for path in _train_shards(data_dir)
+        for _, pixels in iter_parquet_blocks(path)
+    ]
+    start = time.time()
+    for pixels in blocks:
+        image_processor_func(pixels, resize=True, size=(118, 68))
+    return sum(len(pixels) for pixels in blocks), time.time() - start
+
+
+def stage_multi_output_sequence(data_dir):
+    from batch_generator import MultiOutputSequence
+
+    n_images = sum(
+        pq.ParquetFile(path).metadata.num_rows for path in _train_shards(data_dir)
+    )
+    rng = np.random.RandomState(0)
+    x = _synthetic_images(n_images, rng)[:, ::2, ::2, np.newaxis][:, :68, :118]
+    x = np.ascontiguousarray(x)
+    y = {
+        "output_root": rng.randint(0, 168, n_images).astype(np.int16),
+        "output_vowel": rng.randint(0, 11, n_images).astype(np.int16),
+        "output_consonant": rng.randint(0, 7, n_images).astype(np.int16),
+    }
+    sequence = MultiOutputSequence(
+        x,
+        y,
+        batch_size=100,
+        seed=0,
+        rotation_range=10,
+        width_shift_range=0.2,
+        height_shift_range=0.2,
+    )
+    start = time.time()
+    for index in range(len(sequence)):
+        sequence[index]
+    return n_images, time.time() - start
+
+
+def stage_test_func(data_dir):
+    # a small network is enough to time the reading, preprocessing and csv writing around predict
+    from model_creator import model_create
+    from tester import test_func
+
+    model = model_create(
+        input_shape=(68, 118, 1),
+        n_conv_layers=1,
+        conv_nfilters=8,
+        pool_size=4,
+        dense_layer1_count=32,
+        dense_layer2_count=32,
+    )
+    cwd = os.getcwd()
+    os.chdir(data_dir)
+    try:
+        test_func(model, "benchmark", shard_glob="test_image_data_*.parquet")
+    finally:
+        os.chdir(cwd)
+    return sum(
+        pq.ParquetFile(path).metadata.num_rows
+        for path in glob.glob(os.path.join(data_dir, "test_image_data_*.parquet"))
+    )
+
+
+STAGES = {
+    "data_loader": stage_data_loader,
+    "data_loader_streaming": stage_data_loader_streaming,
+    "image_processor_func": stage_image_processor,
+    "multi_output_sequence": stage_multi_output_sequence,
+    "test_func": stage_test_func,
+}
+
+
+def _stage_worker(stage_name, data_dir, queue):
+    # keeping TensorFlow off any GPU so results are comparable between machines
+    os.environ["CUDA_VISIBLE_DEVICES"] = ""
+    try:
+        start = time.time()
+        result = STAGES[stage_name](data_dir)
+        # stages which need setup return their own timing of the part that matters
+        if isinstance(result, tuple):
+            n_images, seconds = result
+        else:
+            n_images, seconds = result, time.time() - start
+        # ru_maxrss is in kilobytes on linux
+        peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        queue.put(
+            {
+                "images": n_images,
+                "seconds": seconds,
+                "images_per_sec": n_images / seconds if seconds > 0 else None,
+                "peak_rss_mb": peak_rss_mb,
+            }
+        )
+    except Exception as e:
+        queue.put({"error": "{}: {}".format(type(e).__name__, e)})
+
+
+def _wait_for_result(process, queue, poll_seconds=1):
+    """
+    Waits for the result of a stage process. A process which dies without putting one on the
+    queue (e.g. killed for running out of memory) gets an error entry instead of blocking forever
+    """
+    while True:
+        try:
+            return queue.get(timeout=poll_seconds)
+        except Empty:
+            if process.is_alive():
+                continue
+        # the process may have put its result just before exiting
+        try:
+            return queue.get(timeout=poll_seconds)
+        except Empty:
+            process.join()
+            return {"error": "Stage process exited with code {}".format(process.exitcode)}
+
+
+def run_benchmarks(data_dir, stages=None, repeats=1):
+    """
+    Times each stage in its own spawned process, keeping the fastest of the repeats
+
+    Arguments:
+        data_dir - Folder with the synthetic shards
+        stages - Names of the stages to run, all of them by default
+        repeats - Number of times each stage is run
+
+    Returns:
+        results - Dictionary with the environment and the results of each stage
+
+    """
+    ctx = multiprocessing.get_context("spawn")
+    results = {
+        "environment": {
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "cpu_count": os.cpu_count(),
+            "numpy": np.__version__,
+            "pandas": pd.__version__,
+            "pyarrow": pa.__version__,
+            "opencv": cv2.__version__,
+        },
+        "stages": {},
+    }
+    for stage_name in stages or STAGES:
+        best = None
+        for _ in range(repeats):
+            queue = ctx.Queue()
+            process = ctx.Process(
+                target=_stage_worker, args=(stage_name, data_dir, queue)
+            )
+            process.start()
+            result = _wait_for_result(process, queue)
+            process.join()
+            if "error" in result:
+                best = result
+                break
+            if best is None or result["seconds"] < best["seconds"]:
+                best = result
+        results["stages"][stage_name] = best
+        print("{:<25} {}".format(stage_name, _format_result(best)))
+    return results
+
+
+def _format_result(result):
+    if "error" in result:
+        return "failed ({})".format(result["error"])
+    return "{:>10.1f} images/s {:>10.1f} MB peak RSS".format(
+        result["images_per_sec"], result["peak_rss_mb"]
+    )
+
+
+def compare_to_baseline(results, baseline, tolerance=0.1):
+    """
+    Prints the change in throughput and peak memory of each stage against a baseline and returns
+    the names of the stages which got slower or used more memory by more than tolerance
+
+    Arguments:
+        results - Results from run_benchmarks
+        baseline - Results of an earlier run, loaded from its json file
+        tolerance - Allowed relative change before a stage counts as a regression
+
+    Returns:
+        regressions - List of stage names
+
+    """
+    regressions = []
+    for stage_name, result in results["stages"].items():
+        base = baseline["stages"].get(stage_name)
+        if base is None or "error" in base or "error" in result:
+            continue
+        speed_change = result["images_per_sec"] / base["images_per_sec"] - 1
+        memory_change = result["peak_rss_mb"] / base["peak_rss_mb"] - 1
+        regressed = speed_change < -tolerance or memory_change > tolerance
+        if regressed:
+            regressions.append(stage_name)
+        print(
+            "{:<25} throughput {:+.1%}  peak RSS {:+.1%}{}".format(
+                stage_name,
+                speed_change,
+                memory_change,
+                "  <-- regression" if regressed else "",
+            )
+        )
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--data-dir", default="./benchmark_data")
+    parser.add_argument("--shards", type=int, default=1)
+    parser.add_argument("--images", type=int, default=1000, help="images per shard")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--stages", nargs="+", choices=sorted(STAGES))
+    parser.add_argument("--repeats", type=int, default=1)
+    parser.add_argument("--output", help="json file to save the results to")
+    parser.add_argument("--baseline", help="json file of an earlier run to compare to")
+    parser.add_argument("--tolerance", type=float, default=0.1)
+    args = parser.parse_args(argv)
+
+    # the synthetic shards are only regenerated when the settings change
+    settings = {"shards": args.shards, "images": args.images, "seed": args.seed}
+    settings_path = os.path.join(args.data_dir, "settings.json")
+    if not os.path.exists(settings_path) or json.load(open(settings_path)) != settings:
+        print("Writing synthetic shards to {}".format(args.data_dir))
+        make_synthetic_shards(args.data_dir, args.shards, args.images, args.seed)
+        with open(settings_path, "w") as f:
+            json.dump(settings, f)
+
+    results = run_benchmarks(args.data_dir, args.stages, args.repeats)
+    results["settings"] = settings
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if compare_to_baseline(results, baseline, args.tolerance):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    # the stage modules are imported from this folder in the worker processes
+    sys.path.insert(1, os.path.dirname(os.path.abspath(__file__)))
+    sys.exit(main())
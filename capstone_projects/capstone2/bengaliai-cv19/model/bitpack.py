@@ -0,0 +1,252 @@
+"""
+Bit-packed storage for thresholded images.
+
+Thresholded images only hold two values, so they are stored as np.packbits bitmaps (one bit per
+pixel) in memory-mappable shard folders, next to their image ids and targets. The full
+resolution training set is about 4KB per image this way, small enough to keep in RAM and in the
+page cache of a modest machine. Note that INTER_AREA resizing averages pixels, so resized images
+have gray edges which are binarized at the threshold when packed
+
+Usage (from the project folder):
+    python model/bitpack.py --out-dir ./packed
+    python model/bitpack.py --out-dir ./packed_64 --width 64 --height 64 --crop-to-ink
+"""
+import os
+import sys
+import json
+import glob
+import shutil
+import argparse
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+
+
+def pack_images(X, threshold=128):
+    """
+    Packs images into one row of bits per image, a pixel being set if it is at least threshold
+
+    Arguments:
+        X - uint8 image array of shape (n_images, ...)
+        threshold - Pixel value from which a pixel counts as white
+
+    Returns:
+        packed - uint8 array of shape (n_images, ceil(n_pixels / 8))
+
+    """
+    X = np.asarray(X).reshape(len(X), -1)
+    return np.packbits(X >= threshold, axis=1)
+
+
+def unpack_images(packed, shape, out=None):
+    """
+    Unpacks rows of bits back into uint8 images of 0 and 255
+
+    Arguments:
+        packed - Packed rows from pack_images
+        shape - Shape of a single image, e.g. (68, 118, 1)
+        out - Optional preallocated uint8 array of shape (n_images,) + shape
+
+    Returns:
+        X - uint8 array of shape (n_images,) + shape
+
+    """
+    n_pixels = int(np.prod(shape))
+    bits = np.unpackbits(packed, axis=1)[:, :n_pixels]
+    if out is None:
+        out = np.empty((len(packed),) + tuple(shape), dtype=np.uint8)
+    np.multiply(bits.reshape(out.shape), 255, out=out)
+    return out
+
+
+def pack_shard(
+    parquet_file_path,
+    df_dict_file,
+    out_path,
+    size=None,
+    crop_to_ink=False,
+    crop_padding=4,
+    block_size=4096,
+):
+    """
+    Thresholds (and optionally crops and resizes) the images of a parquet file and writes them
+    to a packed shard folder with bits.npy, image_ids.npy, labels.npy and meta.json. The folder is
+    built under a temporary name and renamed when complete
+
+    Arguments:
+        parquet_file_path - Location of the parquet file
+        df_dict_file - Dataframe read from train.csv or the label index built from it. Test files
+            have no targets, pass None for them
+        out_path - Location of the shard folder
+        size - New size of images as (width, height), or None to keep the full 137x236 resolution
+            which packs without any loss
+        crop_to_ink, crop_padding, block_size - Same as in data_loader_streaming
+
+    """
+    # the loaders are only needed to build shards, not to read them
+    from data_loader import iter_parquet_blocks
+    from image_processor import image_processor_func
+    from label_index import as_label_index, lookup_labels
+
+    if crop_to_ink and size is None:
+        raise ValueError("crop_to_ink needs a size, so that every image has the same size")
+    label_index = None if df_dict_file is None else as_label_index(df_dict_file)
+    height, width = (137, 236) if size is None else (size[1], size[0])
+    n_images = pq.ParquetFile(parquet_file_path).metadata.num_rows
+    tmp_path = "{}.tmp_{}".format(out_path, os.getpid())
+    os.makedirs(tmp_path)
+    try:
+        bits = np.lib.format.open_memmap(
+            os.path.join(tmp_path, "bits.npy"),
+            mode="w+",
+            dtype=np.uint8,
+            shape=(n_images, (height * width + 7) // 8),
+        )
+        labels = np.empty((n_images, 3), dtype=np.int16)
+        image_ids = []
+        start = 0
+        for ids, pixels in iter_parquet_blocks(parquet_file_path, block_size):
+            stop = start + len(ids)
+            X = image_processor_func(
+                pixels,
+                resize=size is not None,
+                size=size,
+                crop_to_ink=crop_to_ink,
+                crop_padding=crop_padding,
+            )
+            bits[start:stop] = pack_images(X)
+            if label_index is not None:
+                labels[start:stop] = lookup_labels(label_index, ids)
+            image_ids.extend(ids)
+            start = stop
+        bits.flush()
+        del bits
+
+        np.save(os.path.join(tmp_path, "image_ids.npy"), np.array(image_ids, dtype=str))
+        if label_index is not None:
+            np.save(os.path.join(tmp_path, "labels.npy"), labels)
+        with open(os.path.join(tmp_path, "meta.json"), "w") as f:
+            json.dump(
+                {
+                    "source": os.path.abspath(parquet_file_path),
+                    "height": height,
+                    "width": width,
+                    "crop_padding": crop_padding if crop_to_ink else None,
+                },
+                f,
+            )
+    except BaseException:
+        # an unfinished shard is removed rather than left next to the complete ones
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        raise
+    if os.path.exists(out_path):
+        shutil.rmtree(out_path)
+    os.rename(tmp_path, out_path)
+
+
+class PackedShard:
+    """
+    Reader for a shard folder written by pack_shard. The bits are memory-mapped, so opening a
+    shard reads nothing, and rows are unpacked to uint8 images of 0 and 255 only as they are
+    asked for. Indexing a shard with row numbers (or a slice) returns the unpacked images, so it
+    can stand in for the image array of a shard in tf_data_pipeline.make_dataset
+
+    Arguments:
+        path - Location of the shard folder
+
+    """
+
+    def __init__(self, path):
+        with open(os.path.join(path, "meta.json")) as f:
+            self.meta = json.load(f)
+        self.bits = np.load(os.path.join(path, "bits.npy"), mmap_mode="r")
+        self.image_ids = np.load(os.path.join(path, "image_ids.npy"))
+        labels_path = os.path.join(path, "labels.npy")
+        self.labels = np.load(labels_path) if os.path.exists(labels_path) else None
+        self.image_shape = (self.meta["height"], self.meta["width"], 1)
+        self.shape = (len(self.bits),) + self.image_shape
+        self._positions = None
+
+    def __len__(self):
+        return len(self.bits)
+
+    def __getitem__(self, rows):
+        if isinstance(rows, (int, np.integer)):
+            return self.unpack([rows])[0]
+        return self.unpack(rows)
+
+    def unpack(self, rows, out=None):
+        """
+        Unpacks the images at the given row numbers (or slice), into out if it is given
+        """
+        if isinstance(rows, slice):
+            packed = self.bits[rows]
+        else:
+            rows = np.asarray(rows)
+            # reading the memory map in row order is kinder to the disk, the order is put back after
+            order = np.argsort(rows, kind="stable")
+            packed = np.empty((len(rows), self.bits.shape[1]), dtype=np.uint8)
+            packed[order] = self.bits[rows[order]]
+        return unpack_images(packed, self.image_shape, out=out)
+
+    def rows_of(self, image_ids):
+        """
+        Returns the row numbers of the given image ids
+        """
+        if self._positions is None:
+            self._positions = pd.Index(self.image_ids)
+        rows = self._positions.get_indexer(image_ids)
+        if (rows < 0).any():
+            missing = np.asarray(image_ids)[rows < 0]
+            raise KeyError("Image ids {} are not in the shard".format(list(missing[:5])))
+        return rows
+
+    def get_images(self, image_ids, out=None):
+        """
+        Unpacks the images with the given image ids
+        """
+        return self.unpack(self.rows_of(image_ids), out=out)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--data-dir", default="./data")
+    parser.add_argument("--out-dir", default="./packed")
+    parser.add_argument("--width", type=int, help="resize to this width, full size by default")
+    parser.add_argument("--height", type=int, help="resize to this height")
+    parser.add_argument("--crop-to-ink", action="store_true")
+    parser.add_argument("--crop-padding", type=int, default=4)
+    args = parser.parse_args(argv)
+
+    size = None
+    if args.width or args.height:
+        if not (args.width and args.height):
+            parser.error("--width and --height go together")
+        size = (args.width, args.height)
+    if args.crop_to_ink and size is None:
+        parser.error("--crop-to-ink needs --width and --height")
+
+    os.makedirs(args.out_dir, exist_ok=True)
+    train_df = pd.read_csv(os.path.join(args.data_dir, "train.csv"))
+    for prefix in ["train", "test"]:
+        for path in sorted(
+            glob.glob(os.path.join(args.data_dir, "{}_image_data_*.parquet".format(prefix)))
+        ):
+            name = os.path.splitext(os.path.basename(path))[0]
+            out_path = os.path.join(args.out_dir, name)
+            print("Packing {} into {}".format(path, out_path))
+            pack_shard(
+                path,
+                train_df if prefix == "train" else None,
+                out_path,
+                size=size,
+                crop_to_ink=args.crop_to_ink,
+                crop_padding=args.crop_padding,
+            )
+    return 0
+
+
+if __name__ == "__main__":
+    # the loaders are imported from this folder
+    sys.path.insert(1, os.path.dirname(os.path.abspath(__file__)))
+    sys.exit(main())
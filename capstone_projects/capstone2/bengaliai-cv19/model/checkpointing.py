@@ -0,0 +1,127 @@
+import os
+import json
+import time
+import shutil
+import numpy as np
+from keras import backend as K
+from keras.callbacks import Callback
+
+# file in the checkpoint folder which points to the latest complete checkpoint
+STATE_FILE = "state.json"
+
+
+def save_checkpoint(model, checkpoint_dir, shard, epoch, run_id):
+    """
+    Saves the model weights, the optimizer state and the position of the run in it. Each
+    checkpoint goes to its own folder and state.json is only pointed at it once it is complete,
+    so a crash while saving leaves the previous checkpoint usable
+
+    Arguments:
+        model - Keras model being trained
+        checkpoint_dir - Folder of the checkpoints of this run
+        shard - Index of the parquet file being trained on
+        epoch - Number of epochs done on that parquet file
+        run_id - Id of the mlflow run, which a resumed run logs to
+
+    """
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    name = "shard_{}_epoch_{}".format(shard, epoch)
+    path = os.path.join(checkpoint_dir, name)
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.makedirs(path)
+
+    model.save_weights(os.path.join(path, "weights.h5"))
+    # the optimizer state (moments of adam and its iteration count) isn't part of the weights
+    np.savez(
+        os.path.join(path, "optimizer.npz"),
+        *K.batch_get_value(model.optimizer.weights)
+    )
+
+    state = {
+        "checkpoint": name,
+        "shard": shard,
+        "epoch": epoch,
+        "run_id": run_id,
+        "time": time.time(),
+    }
+    state_path = os.path.join(checkpoint_dir, STATE_FILE)
+    with open(state_path + ".tmp", "w") as f:
+        json.dump(state, f)
+    os.replace(state_path + ".tmp", state_path)
+
+    # the older checkpoints aren't needed once the new one is in place
+    for entry in os.scandir(checkpoint_dir):
+        if entry.is_dir() and entry.name != name:
+            shutil.rmtree(entry.path, ignore_errors=True)
+
+
+def load_checkpoint(checkpoint_dir):
+    """
+    Returns the state of the latest checkpoint in checkpoint_dir (with its "shard", "epoch" and
+    "run_id"), or None if there isn't one
+    """
+    state_path = os.path.join(checkpoint_dir, STATE_FILE)
+    if not os.path.exists(state_path):
+        return None
+    with open(state_path) as f:
+        return json.load(f)
+
+
+def restore_checkpoint(model, checkpoint_dir, state):
+    """
+    Loads the weights and optimizer state of the checkpoint described by state into a model
+    created and compiled the same way as the one that was saved
+    """
+    path = os.path.join(checkpoint_dir, state["checkpoint"])
+    model.load_weights(os.path.join(path, "weights.h5"))
+    # keras only creates the optimizer variables along with the training function
+    model._make_train_function()
+    with np.load(os.path.join(path, "optimizer.npz")) as values:
+        model.optimizer.set_weights(
+            [values["arr_{}".format(k)] for k in range(len(values.files))]
+        )
+
+
+def clear_checkpoints(checkpoint_dir):
+    """
+    Removes the checkpoints of a run which finished, so the next run starts from scratch
+    """
+    shutil.rmtree(checkpoint_dir, ignore_errors=True)
+
+
+class ShardCheckpoint(Callback):
+    """
+    Saves a checkpoint every every_n_epochs epochs and when training on a parquet file ends. A
+    file on which a callback such as early stopping ended training early is saved as done, with
+    all its epochs, so a resumed run moves on to the next file like an uninterrupted one would
+
+    Arguments:
+        checkpoint_dir - Folder of the checkpoints of this run
+        shard - Index of the parquet file being trained on
+        run_id - Id of the mlflow run
+        every_n_epochs - Number of epochs between checkpoints
+
+    """
+
+    def __init__(self, checkpoint_dir, shard, run_id, every_n_epochs=1):
+        super(ShardCheckpoint, self).__init__()
+        self.checkpoint_dir = checkpoint_dir
+        self.shard = shard
+        self.run_id = run_id
+        self.every_n_epochs = every_n_epochs
+        self.saved_epoch = None
+
+    def _save(self, epoch):
+        save_checkpoint(self.model, self.checkpoint_dir, self.shard, epoch, self.run_id)
+        self.saved_epoch = epoch
+
+    def on_epoch_end(self, epoch, logs=None):
+        done = epoch + 1
+        if done % self.every_n_epochs == 0 or done == self.params["epochs"]:
+            self._save(done)
+
+    def on_train_end(self, logs=None):
+        # only reached when fit returns, an interrupted run keeps its last mid-file checkpoint
+        if self.saved_epoch != self.params["epochs"]:
+            self._save(self.params["epochs"])
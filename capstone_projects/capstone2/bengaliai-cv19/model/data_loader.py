@@ -1,83 +1,97 @@
+import os
+import warnings
 import pandas as pd
 import numpy as np
-from sklearn.preprocessing import OneHotEncoder
+import pyarrow as pa
+import pyarrow.parquet as pq
 from sklearn.model_selection import train_test_split
 from image_processor import image_processor_func
+from shard_cache import load_or_build
+from label_index import as_label_index, lookup_labels, label_fingerprint
+from split_manifest import split_rows
+from instrumentation import StageProfiler
 
 
-def data_loader(parquet_file_path, df_dict_file, normalize=True, size=(118, 68)):
+def data_loader(
+    parquet_file_path,
+    df_dict_file,
+    normalize=False,
+    size=(118, 68),
+    cache_dir=None,
+    max_cache_bytes=20 * 2 ** 30,
+    profiler=None,
+    crop_to_ink=False,
+    crop_padding=4,
+    split_manifest=None,
+):
     """
-    This function loads up each parquet file, merges with corresponding target values
+    This function loads up each parquet file, looks up the corresponding target values
     , compresses the feature space from 137*236 to a new resolution (by default it goes to
-    half the original resolution, i.e 68*118) and normalizes the data if the user chooses to
-    
-    """
-    # read parquet file and then merge it with the dataframe
-    train_images_df = pd.read_parquet(parquet_file_path)
+    half the original resolution, i.e 68*118) and normalizes the data if the user chooses to.
+    By default the images are returned as uint8 and normalization is left to the model
+    (see rescale_input in model_create), which uses an eighth of the memory of float64 images
 
-    # merge the parquet file data which contains the actual features with the target variables
-    train_df = pd.merge(train_images_df, df_dict_file, on="image_id").drop(
-        ["image_id"], axis=1
-    )
+    If a cache_dir is given, the compressed images are read from (or saved to) the on-disk
+    cache of preprocessed shards instead of being recomputed on every call
 
-    # delete the parquet file dataframe to save memory
-    del train_images_df
-
-    # extract X values from the newly created dataframe - this will have 137*236 columns
-    X = train_df.drop(
-        ["grapheme_root", "vowel_diacritic", "consonant_diacritic", "grapheme"], axis=1
-    ).values
-
-    # extract y values - these will only have 1 column each
-    y_root = train_df.grapheme_root.values
-    y_vowel = train_df.vowel_diacritic.values
-    y_consonant = train_df.consonant_diacritic.values
-
-    # delete the dataframe since we no longer need it
-    del train_df
-
-    # since we have multiple choices for each output, we must OneHotEncode the target variables
-    # i.e categorize them. Remember to use sparse=False. Otherwise the model will not run
-    ohe = OneHotEncoder(sparse=False)
-    y_root = ohe.fit_transform(y_root.reshape(-1, 1))
-    y_vowel = ohe.fit_transform(y_vowel.reshape(-1, 1))
-    y_consonant = ohe.fit_transform(y_consonant.reshape(-1, 1))
-
-    # create train and test sets from yhis data
-    (
-        X_train,
-        X_test,
-        y_train_root,
-        y_test_root,
-        y_train_consonant,
-        y_test_consonant,
-        y_train_vowel,
-        y_test_vowel,
-    ) = train_test_split(X, y_root, y_consonant, y_vowel, test_size=0.1)
+    df_dict_file can be train.csv or, to skip re-indexing it for every shard, the label index
+    built from it. The targets are returned as int16 class ids for use with sparse categorical losses
 
-    # using the image_processor_func defined in the custom image processor module (built using OpenCV),
-    # we apply thresholding filters to the image and then compress the images to the size specified
-    print("Compressing Images")
-    print("-------------------------------------")
-    X_train = X_train.reshape(-1, 137, 236, 1)
-    X_test = X_test.reshape(-1, 137, 236, 1)
-    X_train_resized = image_processor_func(X_train, resize=True, size=size)  # dataframe
-    X_test_resized = image_processor_func(X_test, resize=True, size=size)  # dataframe
+    A StageProfiler can be passed in to time the parquet read, threshold/resize, split and
+    normalization stages
 
-    # extracting only values from the dataframe - this makes normalization much faster
-    X_train_resized = X_train_resized.values
-    X_test_resized = X_test_resized.values
+    If crop_to_ink is true, every image is cropped to its ink (plus crop_padding pixels) before it
+    is resized, see image_processor_func
 
-    # Normalizing images - if needed. Highly recommended
-    if normalize:
-        # instead of loading all the data into memory and normalizing (faster but requires memory)
-        # we go through the data one at a time. this is slower but does not crash your computer
-        # by using up all your memory :)
-        for i in range(X_train_resized.shape[0]):
-            X_train_resized[i] = X_train_resized[i] / 255
+    Given a split_manifest (see split_manifest.py), the validation images are the ones it marks
+    instead of a new random tenth of the shard on every call. To also skip copying the training
+    images out of the shard, use data_loader_split
+    
+    """
+    if profiler is None:
+        profiler = StageProfiler(enabled=False)
+    image_ids, X, y = _load_images(
+        parquet_file_path,
+        as_label_index(df_dict_file),
+        size,
+        cache_dir,
+        max_cache_bytes,
+        profiler,
+        crop_to_ink,
+        crop_padding,
+    )
+    y_root = y[:, 0]
+    y_vowel = y[:, 1]
+    y_consonant = y[:, 2]
+
+    # create train and test sets from this data
+    with profiler.stage("train_test_split"):
+        if split_manifest is not None:
+            # the same stratified split for every experiment, looked up rather than redrawn
+            train_rows, val_rows = split_rows(split_manifest, image_ids)
+            X_train_resized, X_test_resized = X[train_rows], X[val_rows]
+            y_train_root, y_test_root = y_root[train_rows], y_root[val_rows]
+            y_train_consonant = y_consonant[train_rows]
+            y_test_consonant = y_consonant[val_rows]
+            y_train_vowel, y_test_vowel = y_vowel[train_rows], y_vowel[val_rows]
+        else:
+            (
+                X_train_resized,
+                X_test_resized,
+                y_train_root,
+                y_test_root,
+                y_train_consonant,
+                y_test_consonant,
+                y_train_vowel,
+                y_test_vowel,
+            ) = train_test_split(X, y_root, y_consonant, y_vowel, test_size=0.1)
 
-        for i in range(X_test_resized.shape[0]):
-            X_test_resized[i] = X_test_resized[i] / 255
+    # Normalizing images - only needed for models which don't rescale their own inputs
+    if normalize:
+        # a single vectorized pass straight into float32, which is half the memory of float64
+        with profiler.stage("normalization"):
+            X_train_resized = np.multiply(X_train_resized, 1 / 255, dtype=np.float32)
+            X_test_resized = np.multiply(X_test_resized, 1 / 255, dtype=np.float32)
 
     # we now reshape this data to the corresponding dimensions based on the new size of the images
     X_train_resized = X_train_resized.reshape(-1, size[0], size[1], 1)
@@ -88,8 +102,7 @@ def data_loader(parquet_file_path, df_dict_file, normalize=True, size=(118, 68))
     del y_consonant
     del y_vowel
     del X
-    del X_train
-    del X_test
+    del y
 
     # aaaaand we finally return our train, test features and targets! phew!
     return (
@@ -102,3 +115,370 @@ def data_loader(parquet_file_path, df_dict_file, normalize=True, size=(118, 68))
         y_train_vowel,
         y_test_vowel,
     )
+
+
+def _load_images(
+    parquet_file_path,
+    label_index,
+    size,
+    cache_dir,
+    max_cache_bytes,
+    profiler,
+    crop_to_ink,
+    crop_padding,
+):
+    """
+    Shared by data_loader and data_loader_split. Returns the image ids, the flattened uint8
+    images (memory-mapped when they come from the cache) and the int16 (n_images, 3) targets
+    of a parquet file
+    """
+    if cache_dir is not None:
+        # the cached images are already thresholded and resized
+        with profiler.stage("cache_load"):
+            return load_processed_shard(
+                parquet_file_path,
+                label_index,
+                size=size,
+                cache_dir=cache_dir,
+                max_cache_bytes=max_cache_bytes,
+                crop_to_ink=crop_to_ink,
+                crop_padding=crop_padding,
+            )
+
+    with profiler.stage("parquet_read"):
+        # read parquet file
+        train_images_df = pd.read_parquet(parquet_file_path)
+
+        # look up the target variables of each image instead of merging them in
+        image_ids = train_images_df.image_id.values
+        y = lookup_labels(label_index, image_ids)
+
+        # extract X values from the dataframe - this will have 137*236 columns
+        X = train_images_df.drop(["image_id"], axis=1).values
+
+        # delete the parquet file dataframe to save memory
+        del train_images_df
+
+    # using the image_processor_func defined in the custom image processor module (built using OpenCV),
+    # we apply thresholding filters to the image and then compress the images to the size specified
+    print("Compressing Images")
+    print("-------------------------------------")
+    with profiler.stage("threshold_resize"):
+        X = image_processor_func(
+            X.reshape(-1, 137, 236, 1),
+            resize=True,
+            size=size,
+            crop_to_ink=crop_to_ink,
+            crop_padding=crop_padding,
+        )
+    return image_ids, X, y
+
+
+def data_loader_split(
+    parquet_file_path,
+    df_dict_file,
+    split_manifest,
+    normalize=False,
+    size=(118, 68),
+    cache_dir=None,
+    max_cache_bytes=20 * 2 ** 30,
+    profiler=None,
+    crop_to_ink=False,
+    crop_padding=4,
+):
+    """
+    Version of data_loader which leaves the images of a parquet file where they are and returns
+    the row numbers of its training and validation images, as given by the split manifest,
+    instead of copying them out into separate arrays. With a cache_dir the images stay
+    memory-mapped. The training rows are meant to be passed as the indices of a
+    MultiOutputSequence, which gathers each batch straight from the shard
+
+    Arguments:
+        parquet_file_path - Location of the parquet file
+        df_dict_file - Dataframe read from train.csv or the label index built from it
+        split_manifest - Split manifest from split_manifest.build_split_manifest
+        normalize, size, cache_dir, max_cache_bytes, profiler, crop_to_ink,
+        crop_padding - Same as in data_loader
+
+    Returns:
+        X - Images of shape (n_images, height, width, 1)
+        y_root, y_vowel, y_consonant - int16 class ids for each image
+        train_rows, val_rows - Row numbers of the training and validation images
+
+    """
+    if profiler is None:
+        profiler = StageProfiler(enabled=False)
+    image_ids, X, y = _load_images(
+        parquet_file_path,
+        as_label_index(df_dict_file),
+        size,
+        cache_dir,
+        max_cache_bytes,
+        profiler,
+        crop_to_ink,
+        crop_padding,
+    )
+    train_rows, val_rows = split_rows(split_manifest, image_ids)
+
+    if normalize:
+        with profiler.stage("normalization"):
+            X = np.multiply(X, 1 / 255, dtype=np.float32)
+
+    return (
+        X.reshape(-1, size[1], size[0], 1),
+        y[:, 0],
+        y[:, 1],
+        y[:, 2],
+        train_rows,
+        val_rows,
+    )
+
+
+def iter_parquet_blocks(parquet_file_path, block_size=4096, height=137, width=236):
+    """
+    This generator streams a parquet file in blocks of at most block_size images instead of
+    reading the whole file into a dataframe. Each block is copied straight from the arrow
+    columns into a uint8 array.
+
+    With a pyarrow that has ParquetFile.iter_batches, only one arrow batch and one pixel block
+    are held at a time. Older versions (such as the pinned 0.15) can only read a whole row group
+    at once, so there peak memory is bounded by the largest row group of the file rather than by
+    block_size, and a warning says so when a row group holds more than block_size images
+
+    Arguments:
+        parquet_file_path - Location of the parquet file
+        block_size - Maximum number of images per block
+        height, width - Original image dimensions
+
+    Yields:
+        image_ids - Numpy array of image ids in the block
+        pixels - uint8 array of shape (n_images, height, width)
+
+    """
+    parquet_file = pq.ParquetFile(parquet_file_path)
+    n_pixels = height * width
+
+    # newer versions of pyarrow can decode a file batch by batch, older ones (like the 0.15
+    # in our environment) only go down to row groups, which we then slice without copying
+    if hasattr(parquet_file, "iter_batches"):
+        batches = parquet_file.iter_batches(batch_size=block_size)
+    else:
+        metadata = parquet_file.metadata
+        largest_row_group = max(
+            (metadata.row_group(i).num_rows for i in range(metadata.num_row_groups)),
+            default=0,
+        )
+        if largest_row_group > block_size:
+            warnings.warn(
+                "pyarrow {} can't read {} in blocks, it reads whole row groups of up to {} "
+                "images at a time".format(
+                    pa.__version__, parquet_file_path, largest_row_group
+                )
+            )
+        batches = (
+            batch
+            for i in range(parquet_file.num_row_groups)
+            for batch in parquet_file.read_row_group(i).to_batches(block_size)
+        )
+
+    for batch in batches:
+        # the first column holds the image ids, the remaining ones hold a pixel each
+        image_ids = np.asarray(batch.column(0).to_pandas(), dtype=object)
+        pixels = np.empty((batch.num_rows, n_pixels), dtype=np.uint8)
+        for j in range(n_pixels):
+            pixels[:, j] = batch.column(j + 1).to_numpy()
+        yield image_ids, pixels.reshape(-1, height, width)
+
+
+def data_loader_streaming(
+    parquet_file_path,
+    df_dict_file,
+    block_size=4096,
+    size=(118, 68),
+    crop_to_ink=False,
+    crop_padding=4,
+):
+    """
+    Streaming version of data_loader. Rather than reading the whole parquet file and merging
+    it with the target values, this goes through the file block_size images at a time, looks up
+    the targets through an image_id index and yields thresholded and resized chunks. Peak memory
+    depends on block_size and not on the size of the parquet file, as long as pyarrow can read
+    it batch by batch (see iter_parquet_blocks, older versions read a whole row group at once)
+
+    Arguments:
+        parquet_file_path - Location of the parquet file
+        df_dict_file - Dataframe read from train.csv or the label index built from it
+        block_size - Number of images per chunk
+        size - New size of images
+        crop_to_ink, crop_padding - Crop settings passed on to image_processor_func
+
+    Yields:
+        image_ids - Numpy array of image ids in the chunk
+        X - uint8 array of flattened, processed images
+        y_root, y_vowel, y_consonant - int16 class ids for each image
+
+    """
+    # index the targets by image id once, so each chunk is a lookup instead of a merge
+    label_index = as_label_index(df_dict_file)
+
+    for image_ids, pixels in iter_parquet_blocks(parquet_file_path, block_size):
+        y = lookup_labels(label_index, image_ids)
+        X = image_processor_func(
+            pixels,
+            resize=True,
+            size=size,
+            crop_to_ink=crop_to_ink,
+            crop_padding=crop_padding,
+        )
+        del pixels
+        yield image_ids, X, y[:, 0], y[:, 1], y[:, 2]
+
+
+def load_processed_shard(
+    parquet_file_path,
+    df_dict_file,
+    size=(118, 68),
+    cache_dir="./cache",
+    max_cache_bytes=20 * 2 ** 30,
+    block_size=4096,
+    crop_to_ink=False,
+    crop_padding=4,
+):
+    """
+    Returns the thresholded and resized images of a parquet file along with their targets
+    from the on-disk cache. On a cache miss, the parquet file is streamed through
+    data_loader_streaming and the results are written to memory-mapped .npy files
+
+    The cache key is made up of the source file, its modification time, the new image size,
+    the threshold and crop settings and a hash of the labels, so changing any of them (or
+    train.csv) creates a new entry
+
+    Arguments:
+        parquet_file_path - Location of the parquet file
+        df_dict_file - Dataframe read from train.csv or the label index built from it
+        size - New size of images
+        cache_dir - Location of the cache
+        max_cache_bytes - Disk budget of the cache, least recently used shards are evicted past it
+        block_size - Number of images per chunk while building the cache entry
+        crop_to_ink, crop_padding - Crop settings passed on to image_processor_func
+
+    Returns:
+        image_ids - Memory-mapped array of image ids
+        X - Memory-mapped uint8 array of flattened, processed images
+        y - Memory-mapped int16 array with the root, vowel and consonant targets as columns
+
+    """
+    label_index = as_label_index(df_dict_file)
+    key_dict = {
+        "source": os.path.abspath(parquet_file_path),
+        "mtime": os.path.getmtime(parquet_file_path),
+        "size": list(size),
+        "threshold": "binary+otsu",
+        # labels.npy is stored in the entry too
+        "labels": label_fingerprint(label_index),
+    }
+    if crop_to_ink:
+        # only added when cropping, so the entries built without it keep their keys
+        key_dict["crop_padding"] = crop_padding
+
+    def build(entry_path):
+        n_images = pq.ParquetFile(parquet_file_path).metadata.num_rows
+        X = np.lib.format.open_memmap(
+            os.path.join(entry_path, "images.npy"),
+            mode="w+",
+            dtype=np.uint8,
+            shape=(n_images, size[0] * size[1]),
+        )
+        y = np.lib.format.open_memmap(
+            os.path.join(entry_path, "labels.npy"),
+            mode="w+",
+            dtype=np.int16,
+            shape=(n_images, 3),
+        )
+        image_ids = []
+        start = 0
+        for ids, X_chunk, y_root, y_vowel, y_consonant in data_loader_streaming(
+            parquet_file_path,
+            label_index,
+            block_size=block_size,
+            size=size,
+            crop_to_ink=crop_to_ink,
+            crop_padding=crop_padding,
+        ):
+            stop = start + len(ids)
+            X[start:stop] = X_chunk
+            y[start:stop, 0] = y_root
+            y[start:stop, 1] = y_vowel
+            y[start:stop, 2] = y_consonant
+            image_ids.extend(ids)
+            start = stop
+        X.flush()
+        y.flush()
+        del X, y
+        np.save(os.path.join(entry_path, "image_ids.npy"), np.array(image_ids, dtype=str))
+
+    print("Loading cached images for {}".format(parquet_file_path))
+    print("-------------------------------------")
+    arrays = load_or_build(key_dict, build, cache_dir, max_cache_bytes)
+    return arrays["image_ids"], arrays["images"], arrays["labels"]
+
+
+def load_cached_split(
+    parquet_file_paths,
+    df_dict_file,
+    split_manifest,
+    size=(118, 68),
+    cache_dir="./cache",
+    max_cache_bytes=20 * 2 ** 30,
+    crop_to_ink=False,
+    crop_padding=4,
+):
+    """
+    Opens several parquet files at once through the cache of preprocessed shards, for training
+    across shards rather than one shard at a time. The training images stay memory-mapped and
+    only the validation images of every shard are gathered into memory
+
+    Arguments:
+        parquet_file_paths - Locations of the parquet files
+        df_dict_file - Dataframe read from train.csv or the label index built from it
+        split_manifest - Split manifest from split_manifest.build_split_manifest
+        size, cache_dir, max_cache_bytes, crop_to_ink, crop_padding - Same as in data_loader
+
+    Returns:
+        shards - List with, for each parquet file, the memory-mapped images of shape
+            (n_images, height, width, 1), the int16 (n_images, 3) targets and the row numbers
+            of its training images
+        x_val - Validation images of every file
+        y_val - Dictionary of output name to validation targets
+
+    """
+    label_index = as_label_index(df_dict_file)
+    shards = []
+    x_val = []
+    y_val = []
+    for parquet_file_path in parquet_file_paths:
+        image_ids, X, y = load_processed_shard(
+            parquet_file_path,
+            label_index,
+            size=size,
+            cache_dir=cache_dir,
+            max_cache_bytes=max_cache_bytes,
+            crop_to_ink=crop_to_ink,
+            crop_padding=crop_padding,
+        )
+        X = X.reshape(-1, size[1], size[0], 1)
+        train_rows, val_rows = split_rows(split_manifest, image_ids)
+        shards.append((X, y, train_rows))
+        x_val.append(X[val_rows])
+        y_val.append(y[val_rows])
+
+    y_val = np.concatenate(y_val)
+    return (
+        shards,
+        np.concatenate(x_val),
+        {
+            "output_root": y_val[:, 0],
+            "output_vowel": y_val[:, 1],
+            "output_consonant": y_val[:, 2],
+        },
+    )
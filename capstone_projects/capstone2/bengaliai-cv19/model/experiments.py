@@ -1,12 +1,44 @@
+import numpy as np
 import mlflow
 import mlflow.keras
-from data_loader import data_loader
-from keras.preprocessing.image import ImageDataGenerator
-from batch_generator import MultiOutputDataGenerator
+from mlflow.tracking import MlflowClient
+from keras.utils import OrderedEnqueuer
+from data_loader import data_loader, data_loader_split, load_cached_split
+from split_manifest import build_split_manifest
+from label_index import build_label_index
+from prefetcher import prefetch_shards
+from instrumentation import StageProfiler
+from batch_generator import MultiOutputSequence, MultiShardSequence
+from checkpointing import (
+    ShardCheckpoint,
+    load_checkpoint,
+    restore_checkpoint,
+    clear_checkpoints,
+)
 
 
 def run_experiment_with_callbacks(
-    name, model, callbacks_list, batch_size, epochs, df_dict, data_augmentation=False
+    name,
+    model,
+    callbacks_list,
+    batch_size,
+    epochs,
+    df_dict,
+    data_augmentation=False,
+    cache_dir=None,
+    normalize=False,
+    prefetch=False,
+    workers=1,
+    use_multiprocessing=False,
+    profile=False,
+    chrome_trace_path=None,
+    size=(118, 68),
+    crop_to_ink=False,
+    split_manifest=None,
+    input_backend="numpy",
+    checkpoint_dir=None,
+    checkpoint_every=1,
+    epoch_mode="per_shard",
 ):
     """
     This function is the control tower from which we run our experiments with callbacks (early stopping). 
@@ -16,116 +48,93 @@ def run_experiment_with_callbacks(
     saves it under the name given. 
 
     This enables the experiments to be visualized later using mlflow ui
-    
-    """
-    # starting the mlflow logging
-    mlflow.keras.autolog()
-    mlflow.create_experiment(name)
-    mlflow.set_experiment(name)
 
-    with mlflow.start_run():
-        # start a loop which goes through each of the parquet files 1 by 1
-        for i in range(4):
-            print("Reading parquet file #{}".format(i + 1))
-            print("-------------------------------------")
-            print("Transforming data for parquet file #{}".format(i + 1))
-            print("-------------------------------------")
-            # load the training and test splits
-            (
-                x_train,
-                x_test,
-                y_train_root,
-                y_test_root,
-                y_train_consonant,
-                y_test_consonant,
-                y_train_vowel,
-                y_test_vowel,
-            ) = data_loader(
-                "./data/train_image_data_{}.parquet".format(i),
-                df_dict["train"],
-                normalize=True,
-                size=(118, 68),
-            )
+    If a cache_dir is given, the preprocessed shards are reused across experiments instead of
+    being thresholded and resized again. Images are kept as uint8 unless normalize is true,
+    which is only needed for models created without rescale_input
 
-            x_train = x_train.reshape(-1, 68, 118, 1)
-            x_test = x_test.reshape(-1, 68, 118, 1)
+    If prefetch is true, the next parquet file is prepared in a background process while the
+    model trains on the current one. The time spent waiting for data is logged to mlflow
 
-            print("Transformation done")
-            print("-------------------------------------")
-            # calculate number of steps that will be used in training
-            steps = x_train.shape[0] // batch_size
-            if data_augmentation:
-                # we will be using just the rotation and pixel shift augmentations
-                datagen = MultiOutputDataGenerator(
-                    rotation_range=10, width_shift_range=0.2, height_shift_range=0.2
-                )
-                print("Augmenting Input Data")
-                print("-------------------------------------")
-                # fitting the data generator to our training data
-                datagen.fit(x_train)
-                print("Training model on parquet file #{}".format(i + 1))
-                print("-------------------------------------")
-                # training the model with the generator in place
-                model.fit_generator(
-                    datagen.flow(
-                        x_train,
-                        {
-                            "output_root": y_train_root,
-                            "output_vowel": y_train_vowel,
-                            "output_consonant": y_train_consonant,
-                        },
-                        batch_size=batch_size,
-                    ),
-                    epochs=epochs,
-                    validation_data=(
-                        x_test,
-                        [y_test_root, y_test_vowel, y_test_consonant],
-                    ),
-                    steps_per_epoch=steps,
-                    callbacks=callbacks_list,
-                )
-            else:
-                # if we don't need augmentation, we straight up train the model
-                print("Training model on parquet file #{}".format(i + 1))
-                print("-------------------------------------")
-                model.fit(
-                    x=x_train,
-                    y={
-                        "output_root": y_train_root,
-                        "output_vowel": y_train_vowel,
-                        "output_consonant": y_train_consonant,
-                    },
-                    epochs=epochs,
-                    batch_size=batch_size,
-                    validation_data=(
-                        x_test,
-                        {
-                            "output_root": y_test_root,
-                            "output_vowel": y_test_vowel,
-                            "output_consonant": y_test_consonant,
-                        },
-                    ),
-                    callbacks=callbacks_list,
-                )
-            print("Training finished on parquet file #{}".format(i + 1))
-            print("-------------------------------------")
-            print("Deleting variables after training")
+    With data augmentation, batches are built by a MultiOutputSequence on the given number of
+    workers (threads, or processes if use_multiprocessing is true)
 
-            # finally, as per usual, delete unnecessary variables before moving to file
-            del (
-                x_train,
-                x_test,
-                y_train_root,
-                y_test_root,
-                y_train_consonant,
-                y_test_consonant,
-                y_train_vowel,
-                y_test_vowel,
-            )
+    If profile is true, the time and memory used by each stage (parquet read, threshold/resize,
+    normalization, augmentation and model.fit) are logged to mlflow per parquet file, and also saved
+    as a Chrome trace if a chrome_trace_path is given
+
+    size is the (width, height) the images are resized to, which has to match the input_shape of
+    the model. With crop_to_ink, every image is first cropped to its ink, so smaller sizes such as
+    (64, 64) keep most of the detail
+
+    Given a split_manifest (see split_manifest.py), every experiment validates on the same
+    stratified set of images, and the model trains through a MultiOutputSequence which gathers
+    its batches straight from the shard instead of from a copy of the training images
+
+    With input_backend="tf_data", the model trains on all four parquet files at once through a
+    tf.data pipeline (see tf_data_pipeline.py), which shuffles across files and augments and
+    prefetches batches on several threads while the model trains. It needs a cache_dir, and
+    validates on the split_manifest (a default one is built if none is given)
+
+    If a checkpoint_dir is given, the weights, optimizer state, parquet file, epoch and mlflow run
+    id are saved there every checkpoint_every epochs. Calling the function again with the same
+    checkpoint_dir and a freshly created model picks the run up where it stopped, logging to the
+    same mlflow run. The checkpoints are removed once the run finishes. The state of callbacks
+    such as early stopping starts over on resume
+
+    By default (epoch_mode="per_shard") the model is trained for all its epochs on one parquet
+    file before moving on to the next. With epoch_mode="interleaved", an epoch is a single pass
+    over all four files, drawn in a shuffled order across them by a MultiShardSequence, so callbacks
+    see one continuous training history. Like the tf_data backend, which always trains this way, it
+    needs a cache_dir and validates on the split_manifest
+    
+    """
+    _run_experiment(
+        name,
+        model,
+        callbacks_list,
+        batch_size,
+        epochs,
+        df_dict,
+        data_augmentation=data_augmentation,
+        cache_dir=cache_dir,
+        normalize=normalize,
+        prefetch=prefetch,
+        workers=workers,
+        use_multiprocessing=use_multiprocessing,
+        profile=profile,
+        chrome_trace_path=chrome_trace_path,
+        size=size,
+        crop_to_ink=crop_to_ink,
+        split_manifest=split_manifest,
+        input_backend=input_backend,
+        checkpoint_dir=checkpoint_dir,
+        checkpoint_every=checkpoint_every,
+        epoch_mode=epoch_mode,
+    )
 
 
 def run_experiment_without_callbacks(
-    name, model, batch_size, epochs, df_dict, data_augmentation=False
+    name,
+    model,
+    batch_size,
+    epochs,
+    df_dict,
+    data_augmentation=False,
+    cache_dir=None,
+    normalize=False,
+    prefetch=False,
+    workers=1,
+    use_multiprocessing=False,
+    profile=False,
+    chrome_trace_path=None,
+    size=(118, 68),
+    crop_to_ink=False,
+    split_manifest=None,
+    input_backend="numpy",
+    checkpoint_dir=None,
+    checkpoint_every=1,
+    epoch_mode="per_shard",
 ):
     """
     This function is the control tower from which we run our experiments without callbacks (early stopping). 
@@ -135,95 +144,327 @@ def run_experiment_without_callbacks(
     saves it under the name given. 
 
     This enables the experiments to be visualized later using mlflow ui
+
+    If a cache_dir is given, the preprocessed shards are reused across experiments instead of
+    being thresholded and resized again. Images are kept as uint8 unless normalize is true,
+    which is only needed for models created without rescale_input
+
+    If prefetch is true, the next parquet file is prepared in a background process while the
+    model trains on the current one. The time spent waiting for data is logged to mlflow
+
+    With data augmentation, batches are built by a MultiOutputSequence on the given number of
+    workers (threads, or processes if use_multiprocessing is true)
+
+    If profile is true, the time and memory used by each stage (parquet read, threshold/resize,
+    normalization, augmentation and model.fit) are logged to mlflow per parquet file, and also saved
+    as a Chrome trace if a chrome_trace_path is given
+
+    size is the (width, height) the images are resized to, which has to match the input_shape of
+    the model. With crop_to_ink, every image is first cropped to its ink, so smaller sizes such as
+    (64, 64) keep most of the detail
+
+    Given a split_manifest (see split_manifest.py), every experiment validates on the same
+    stratified set of images, and the model trains through a MultiOutputSequence which gathers
+    its batches straight from the shard instead of from a copy of the training images
+
+    With input_backend="tf_data", the model trains on all four parquet files at once through a
+    tf.data pipeline (see tf_data_pipeline.py), which shuffles across files and augments and
+    prefetches batches on several threads while the model trains. It needs a cache_dir, and
+    validates on the split_manifest (a default one is built if none is given)
+
+    If a checkpoint_dir is given, the weights, optimizer state, parquet file, epoch and mlflow run
+    id are saved there every checkpoint_every epochs. Calling the function again with the same
+    checkpoint_dir and a freshly created model picks the run up where it stopped, logging to the
+    same mlflow run. The checkpoints are removed once the run finishes. The state of callbacks
+    such as early stopping starts over on resume
+
+    By default (epoch_mode="per_shard") the model is trained for all its epochs on one parquet
+    file before moving on to the next. With epoch_mode="interleaved", an epoch is a single pass
+    over all four files, drawn in a shuffled order across them by a MultiShardSequence, so callbacks
+    see one continuous training history. Like the tf_data backend, which always trains this way, it
+    needs a cache_dir and validates on the split_manifest
     
     """
-    # starting the mlflow logging
+    _run_experiment(
+        name,
+        model,
+        None,
+        batch_size,
+        epochs,
+        df_dict,
+        data_augmentation=data_augmentation,
+        cache_dir=cache_dir,
+        normalize=normalize,
+        prefetch=prefetch,
+        workers=workers,
+        use_multiprocessing=use_multiprocessing,
+        profile=profile,
+        chrome_trace_path=chrome_trace_path,
+        size=size,
+        crop_to_ink=crop_to_ink,
+        split_manifest=split_manifest,
+        input_backend=input_backend,
+        checkpoint_dir=checkpoint_dir,
+        checkpoint_every=checkpoint_every,
+        epoch_mode=epoch_mode,
+    )
+
+
+def _run_experiment(
+    name,
+    model,
+    callbacks_list,
+    batch_size,
+    epochs,
+    df_dict,
+    data_augmentation=False,
+    cache_dir=None,
+    normalize=False,
+    prefetch=False,
+    workers=1,
+    use_multiprocessing=False,
+    profile=False,
+    chrome_trace_path=None,
+    size=(118, 68),
+    crop_to_ink=False,
+    split_manifest=None,
+    input_backend="numpy",
+    checkpoint_dir=None,
+    checkpoint_every=1,
+    epoch_mode="per_shard",
+):
+    """
+    Shared training loop behind run_experiment_with_callbacks and run_experiment_without_callbacks.
+    A callbacks_list of None trains without callbacks
+    """
+    # starting the mlflow logging. The experiment may already exist if this is a retry
     mlflow.keras.autolog()
-    mlflow.create_experiment(name)
+    if mlflow.get_experiment_by_name(name) is None:
+        mlflow.create_experiment(name)
     mlflow.set_experiment(name)
 
-    with mlflow.start_run():
+    # the labels are indexed once here rather than once per parquet file
+    label_index = build_label_index(df_dict["train"])
+
+    # picking up an interrupted run from its last checkpoint, if there is one
+    start_shard, initial_epoch, run_id = 0, 0, None
+    state = load_checkpoint(checkpoint_dir) if checkpoint_dir is not None else None
+    if state is not None:
+        restore_checkpoint(model, checkpoint_dir, state)
+        start_shard, initial_epoch, run_id = state["shard"], state["epoch"], state["run_id"]
+        print(
+            "Resuming run {} at parquet file #{} after epoch {}".format(
+                run_id, start_shard + 1, initial_epoch
+            )
+        )
+
+    def fit_callbacks(shard, run):
+        # the checkpoint callback is added to a copy, the given list is reused for every file
+        fit_callbacks_list = list(callbacks_list or [])
+        if checkpoint_dir is not None:
+            fit_callbacks_list.append(
+                ShardCheckpoint(
+                    checkpoint_dir, shard, run.info.run_id, checkpoint_every
+                )
+            )
+        return fit_callbacks_list
+
+    # a disabled profiler records nothing, so we can use it unconditionally
+    profiler = StageProfiler(enabled=profile)
+    profiler.shard = start_shard
+
+    if input_backend not in ("numpy", "tf_data"):
+        raise ValueError("Unknown input_backend {}".format(input_backend))
+    if epoch_mode not in ("per_shard", "interleaved"):
+        raise ValueError("Unknown epoch_mode {}".format(epoch_mode))
+
+    if input_backend == "tf_data" or epoch_mode == "interleaved":
+        with mlflow.start_run(run_id=run_id) as run:
+            _fit_across_shards(
+                model,
+                fit_callbacks(0, run),
+                batch_size,
+                epochs,
+                df_dict,
+                label_index,
+                data_augmentation,
+                cache_dir,
+                normalize,
+                size,
+                crop_to_ink,
+                split_manifest,
+                profiler,
+                input_backend,
+                workers,
+                use_multiprocessing,
+                initial_epoch,
+            )
+            profiler.log_to_mlflow()
+            if chrome_trace_path is not None:
+                profiler.export_chrome_trace(chrome_trace_path)
+                mlflow.log_artifact(chrome_trace_path)
+        if checkpoint_dir is not None:
+            clear_checkpoints(checkpoint_dir)
+        return
+
+    if initial_epoch >= epochs:
+        # the parquet file was done (or stopped early) when the checkpoint was taken
+        start_shard, initial_epoch = start_shard + 1, 0
+
+    loader_kwargs = {
+        "normalize": normalize,
+        "size": size,
+        "cache_dir": cache_dir,
+        "crop_to_ink": crop_to_ink,
+    }
+    if not prefetch:
+        # the stages inside data_loader can only be timed when it runs in this process
+        loader_kwargs["profiler"] = profiler
+
+    # the parquet files are read and transformed by the prefetcher, in the background if asked to
+    if split_manifest is None:
+        shards = prefetch_shards(
+            data_loader,
+            [
+                ("./data/train_image_data_{}.parquet".format(i), label_index)
+                for i in range(start_shard, 4)
+            ],
+            kwargs=loader_kwargs,
+            prefetch=prefetch,
+        )
+    else:
+        shards = prefetch_shards(
+            data_loader_split,
+            [
+                (
+                    "./data/train_image_data_{}.parquet".format(i),
+                    label_index,
+                    split_manifest,
+                )
+                for i in range(start_shard, 4)
+            ],
+            kwargs=loader_kwargs,
+            prefetch=prefetch,
+        )
+    total_wait_time = 0
+
+    with mlflow.start_run(run_id=run_id) as run:
         # start a loop which goes through each of the parquet files 1 by 1
-        for i in range(4):
-            print("Reading parquet file #{}".format(i + 1))
-            print("-------------------------------------")
-            print("Transforming data for parquet file #{}".format(i + 1))
+        for k, shard, wait_time in shards:
+            # parquet files done before a resume are skipped
+            i = start_shard + k
+            shard_initial_epoch = initial_epoch if i == start_shard else 0
+            print("Reading and transforming parquet file #{}".format(i + 1))
             print("-------------------------------------")
-            # load the training and test splits
-            (
-                x_train,
-                x_test,
-                y_train_root,
-                y_test_root,
-                y_train_consonant,
-                y_test_consonant,
-                y_train_vowel,
-                y_test_vowel,
-            ) = data_loader(
-                "./data/train_image_data_{}.parquet".format(i),
-                df_dict["train"],
-                normalize=True,
-                size=(118, 68),
-            )
+            train_rows = None
+            if split_manifest is None:
+                # unpack the training and test splits
+                (
+                    x_train,
+                    x_test,
+                    y_train_root,
+                    y_test_root,
+                    y_train_consonant,
+                    y_test_consonant,
+                    y_train_vowel,
+                    y_test_vowel,
+                ) = shard
+            else:
+                # the whole shard is used for training, through the indices of its training rows,
+                # and only the validation images are copied out
+                (
+                    x_train,
+                    y_train_root,
+                    y_train_vowel,
+                    y_train_consonant,
+                    train_rows,
+                    val_rows,
+                ) = shard
+                x_test = x_train[val_rows]
+                y_test_root = y_train_root[val_rows]
+                y_test_vowel = y_train_vowel[val_rows]
+                y_test_consonant = y_train_consonant[val_rows]
+            del shard
 
-            x_train = x_train.reshape(-1, 68, 118, 1)
-            x_test = x_test.reshape(-1, 68, 118, 1)
+            # keeping track of how long training had to wait for the data
+            total_wait_time += wait_time
+            mlflow.log_metric("data_wait_seconds", wait_time, step=i)
+            print("Waited {:.1f}s for parquet file #{}".format(wait_time, i + 1))
+
+            x_train = x_train.reshape(-1, size[1], size[0], 1)
+            x_test = x_test.reshape(-1, size[1], size[0], 1)
 
             print("Transformation done")
             print("-------------------------------------")
             # calculate number of steps that will be used in training
-            steps = x_train.shape[0] // batch_size
-            if data_augmentation:
-                # we will be using just the rotation and pixel shift augmentations
-                datagen = MultiOutputDataGenerator(
-                    rotation_range=10, width_shift_range=0.2, height_shift_range=0.2
+            n_train = x_train.shape[0] if train_rows is None else len(train_rows)
+            steps = n_train // batch_size
+            if data_augmentation or train_rows is not None:
+                augmentation = {}
+                if data_augmentation:
+                    # we will be using just the rotation and pixel shift augmentations
+                    print("Augmenting Input Data")
+                    print("-------------------------------------")
+                    augmentation = {
+                        "rotation_range": 10,
+                        "width_shift_range": 0.2,
+                        "height_shift_range": 0.2,
+                    }
+                train_sequence = MultiOutputSequence(
+                    x_train,
+                    {
+                        "output_root": y_train_root,
+                        "output_vowel": y_train_vowel,
+                        "output_consonant": y_train_consonant,
+                    },
+                    batch_size=batch_size,
+                    indices=train_rows,
+                    workers=workers,
+                    profiler=profiler,
+                    **augmentation
                 )
-                print("Augmenting Input Data")
-                print("-------------------------------------")
-                # fitting the data generator to our training data
-                datagen.fit(x_train)
                 print("Training model on parquet file #{}".format(i + 1))
                 print("-------------------------------------")
                 # training the model with the generator in place
-                model.fit_generator(
-                    datagen.flow(
-                        x_train,
-                        {
-                            "output_root": y_train_root,
-                            "output_vowel": y_train_vowel,
-                            "output_consonant": y_train_consonant,
-                        },
-                        batch_size=batch_size,
-                    ),
-                    epochs=epochs,
-                    validation_data=(
-                        x_test,
-                        [y_test_root, y_test_vowel, y_test_consonant],
-                    ),
-                    steps_per_epoch=steps,
-                )
+                with profiler.stage("model_fit"):
+                    model.fit_generator(
+                        train_sequence,
+                        epochs=epochs,
+                        validation_data=(
+                            x_test,
+                            [y_test_root, y_test_vowel, y_test_consonant],
+                        ),
+                        steps_per_epoch=steps,
+                        workers=workers,
+                        use_multiprocessing=use_multiprocessing,
+                        callbacks=fit_callbacks(i, run),
+                        initial_epoch=shard_initial_epoch,
+                    )
             else:
                 # if we don't need augmentation, we straight up train the model
                 print("Training model on parquet file #{}".format(i + 1))
                 print("-------------------------------------")
-                model.fit(
-                    x=x_train,
-                    y={
-                        "output_root": y_train_root,
-                        "output_vowel": y_train_vowel,
-                        "output_consonant": y_train_consonant,
-                    },
-                    epochs=epochs,
-                    batch_size=batch_size,
-                    validation_data=(
-                        x_test,
-                        {
-                            "output_root": y_test_root,
-                            "output_vowel": y_test_vowel,
-                            "output_consonant": y_test_consonant,
+                with profiler.stage("model_fit"):
+                    model.fit(
+                        x=x_train,
+                        y={
+                            "output_root": y_train_root,
+                            "output_vowel": y_train_vowel,
+                            "output_consonant": y_train_consonant,
                         },
-                    ),
-                )
+                        epochs=epochs,
+                        batch_size=batch_size,
+                        validation_data=(
+                            x_test,
+                            {
+                                "output_root": y_test_root,
+                                "output_vowel": y_test_vowel,
+                                "output_consonant": y_test_consonant,
+                            },
+                        ),
+                        callbacks=fit_callbacks(i, run),
+                        initial_epoch=shard_initial_epoch,
+                    )
             print("Training finished on parquet file #{}".format(i + 1))
             print("-------------------------------------")
             print("Deleting variables after training")
@@ -239,3 +480,292 @@ def run_experiment_without_callbacks(
                 y_train_vowel,
                 y_test_vowel,
             )
+            # in-process loading of the next parquet file happens when the loop asks for it
+            profiler.shard = i + 1
+
+        print("Total time spent waiting for data: {:.1f}s".format(total_wait_time))
+        mlflow.log_metric("total_data_wait_seconds", total_wait_time)
+
+        profiler.log_to_mlflow()
+        if chrome_trace_path is not None:
+            profiler.export_chrome_trace(chrome_trace_path)
+            mlflow.log_artifact(chrome_trace_path)
+
+    if checkpoint_dir is not None:
+        clear_checkpoints(checkpoint_dir)
+
+
+def _fit_across_shards(
+    model,
+    callbacks_list,
+    batch_size,
+    epochs,
+    df_dict,
+    label_index,
+    data_augmentation,
+    cache_dir,
+    normalize,
+    size,
+    crop_to_ink,
+    split_manifest,
+    profiler,
+    input_backend,
+    workers,
+    use_multiprocessing,
+    initial_epoch=0,
+):
+    """
+    Trains the model on every parquet file at once, with each epoch a pass over all of them,
+    through the tf.data input pipeline or a MultiShardSequence. The cached images are uint8, with
+    normalize they are scaled to [0, 1] batch by batch
+    """
+    if cache_dir is None:
+        raise ValueError("Training across parquet files reads from the cache, it needs a cache_dir")
+    if split_manifest is None:
+        split_manifest = build_split_manifest(df_dict["train"])
+
+    with profiler.stage("cache_load"):
+        shards, x_val, y_val = load_cached_split(
+            ["./data/train_image_data_{}.parquet".format(i) for i in range(4)],
+            label_index,
+            split_manifest,
+            size=size,
+            cache_dir=cache_dir,
+            crop_to_ink=crop_to_ink,
+        )
+    if normalize:
+        x_val = np.multiply(x_val, 1 / 255, dtype=np.float32)
+
+    augmentation = {}
+    if data_augmentation:
+        augmentation = {
+            "rotation_range": 10,
+            "width_shift_range": 0.2,
+            "height_shift_range": 0.2,
+        }
+
+    print("Training model on all parquet files")
+    print("-------------------------------------")
+    if input_backend == "tf_data":
+        # tensorflow is only needed by this backend
+        from tf_data_pipeline import make_dataset, dataset_generator, steps_per_epoch
+
+        dataset = make_dataset(
+            shards, batch_size=batch_size, normalize=normalize, **augmentation
+        )
+        with profiler.stage("model_fit"):
+            # the dataset builds its batches on its own threads, so keras doesn't need any workers
+            model.fit_generator(
+                dataset_generator(dataset),
+                steps_per_epoch=steps_per_epoch(shards, batch_size),
+                epochs=epochs,
+                validation_data=(x_val, y_val),
+                workers=0,
+                callbacks=callbacks_list,
+                initial_epoch=initial_epoch,
+            )
+    else:
+        train_sequence = MultiShardSequence(
+            shards,
+            batch_size=batch_size,
+            workers=workers,
+            profiler=profiler,
+            normalize=normalize,
+            **augmentation
+        )
+        with profiler.stage("model_fit"):
+            model.fit_generator(
+                train_sequence,
+                epochs=epochs,
+                validation_data=(x_val, y_val),
+                workers=workers,
+                use_multiprocessing=use_multiprocessing,
+                callbacks=callbacks_list,
+                initial_epoch=initial_epoch,
+            )
+
+
+def run_experiment_multi_model(
+    names,
+    models,
+    batch_size,
+    epochs,
+    df_dict,
+    data_augmentation=False,
+    cache_dir=None,
+    normalize=False,
+    prefetch=False,
+    workers=1,
+    use_multiprocessing=False,
+    size=(118, 68),
+    crop_to_ink=False,
+    split_manifest=None,
+):
+    """
+    This function trains several models on a single pass over the data. Every batch is loaded
+    (and augmented) once and then used for a training step of each model in turn, so the cost of the
+    data is paid once per batch instead of once per model. Useful for grids where only the
+    model_create parameters change. Create the models with reset_session=False so they can live
+    side by side
+
+    Each model gets its own mlflow experiment and run under the matching name, with the same
+    training and validation metrics (one step per epoch) that autolog records. Callbacks such as
+    early stopping are not supported here. If training fails, the runs of every model are marked
+    as failed in mlflow
+
+    Arguments:
+        names - List of experiment names, one per model
+        models - List of compiled models
+        batch_size, epochs, df_dict, data_augmentation, cache_dir, normalize, prefetch, workers,
+        use_multiprocessing, size, crop_to_ink,
+        split_manifest - Same as in run_experiment_without_callbacks. All the models get the same
+            input, so with normalize they should all be created without rescale_input
+
+    """
+    client = MlflowClient()
+    run_ids = []
+    for name in names:
+        experiment = client.get_experiment_by_name(name)
+        if experiment is None:
+            experiment_id = client.create_experiment(name)
+        else:
+            experiment_id = experiment.experiment_id
+        run_ids.append(client.create_run(experiment_id).info.run_id)
+
+    try:
+        label_index = build_label_index(df_dict["train"])
+        loader_kwargs = {
+            "normalize": normalize,
+            "size": size,
+            "cache_dir": cache_dir,
+            "crop_to_ink": crop_to_ink,
+        }
+        if split_manifest is None:
+            shards = prefetch_shards(
+                data_loader,
+                [
+                    ("./data/train_image_data_{}.parquet".format(i), label_index)
+                    for i in range(4)
+                ],
+                kwargs=loader_kwargs,
+                prefetch=prefetch,
+            )
+        else:
+            shards = prefetch_shards(
+                data_loader_split,
+                [
+                    (
+                        "./data/train_image_data_{}.parquet".format(i),
+                        label_index,
+                        split_manifest,
+                    )
+                    for i in range(4)
+                ],
+                kwargs=loader_kwargs,
+                prefetch=prefetch,
+            )
+
+        for i, shard, wait_time in shards:
+            train_rows = None
+            if split_manifest is None:
+                (
+                    x_train,
+                    x_test,
+                    y_train_root,
+                    y_test_root,
+                    y_train_consonant,
+                    y_test_consonant,
+                    y_train_vowel,
+                    y_test_vowel,
+                ) = shard
+            else:
+                (
+                    x_train,
+                    y_train_root,
+                    y_train_vowel,
+                    y_train_consonant,
+                    train_rows,
+                    val_rows,
+                ) = shard
+                x_test = x_train[val_rows]
+                y_test_root = y_train_root[val_rows]
+                y_test_vowel = y_train_vowel[val_rows]
+                y_test_consonant = y_train_consonant[val_rows]
+            del shard
+            x_train = x_train.reshape(-1, size[1], size[0], 1)
+            x_test = x_test.reshape(-1, size[1], size[0], 1)
+            y_test = {
+                "output_root": y_test_root,
+                "output_vowel": y_test_vowel,
+                "output_consonant": y_test_consonant,
+            }
+            for run_id in run_ids:
+                client.log_metric(run_id, "data_wait_seconds", wait_time, step=i)
+
+            augmentation = {}
+            if data_augmentation:
+                augmentation = {
+                    "rotation_range": 10,
+                    "width_shift_range": 0.2,
+                    "height_shift_range": 0.2,
+                }
+            train_sequence = MultiOutputSequence(
+                x_train,
+                {
+                    "output_root": y_train_root,
+                    "output_vowel": y_train_vowel,
+                    "output_consonant": y_train_consonant,
+                },
+                batch_size=batch_size,
+                indices=train_rows,
+                workers=workers,
+                **augmentation
+            )
+
+            print("Training {} models on parquet file #{}".format(len(models), i + 1))
+            print("-------------------------------------")
+            # the enqueuer builds the next batches in the background while the models train
+            enqueuer = OrderedEnqueuer(train_sequence, use_multiprocessing=use_multiprocessing)
+            enqueuer.start(workers=workers, max_queue_size=10)
+            batches = enqueuer.get()
+            try:
+                for epoch in range(epochs):
+                    totals = [0.0] * len(models)
+                    n_seen = 0
+                    for _ in range(len(train_sequence)):
+                        batch_x, batch_y = next(batches)
+                        n = len(batch_x)
+                        n_seen += n
+                        for k, model in enumerate(models):
+                            # train_on_batch returns the loss followed by every other metric
+                            totals[k] = totals[k] + n * np.asarray(
+                                model.train_on_batch(batch_x, batch_y)
+                            )
+
+                    for k, model in enumerate(models):
+                        train_values = totals[k] / n_seen
+                        val_values = model.evaluate(
+                            x_test, y_test, batch_size=batch_size, verbose=0
+                        )
+                        for metric, train_value, val_value in zip(
+                            model.metrics_names, train_values, val_values
+                        ):
+                            client.log_metric(run_ids[k], metric, float(train_value), step=epoch)
+                            client.log_metric(
+                                run_ids[k], "val_" + metric, float(val_value), step=epoch
+                            )
+                    print("Epoch {}/{} done for all models".format(epoch + 1, epochs))
+            finally:
+                enqueuer.stop()
+
+            del x_train, x_test, train_sequence
+
+        # saving the trained models as artifacts of their runs, like autolog does
+        for model, run_id in zip(models, run_ids):
+            with mlflow.start_run(run_id=run_id):
+                mlflow.keras.log_model(model, "model")
+    except BaseException:
+        # otherwise the runs would be left as running in mlflow
+        for run_id in run_ids:
+            client.set_terminated(run_id, "FAILED")
+        raise
@@ -0,0 +1,277 @@
+import os
+import time
+import itertools
+import traceback
+import multiprocessing
+from data_loader import load_processed_shard
+from label_index import build_label_index
+from mlflow.tracking import MlflowClient
+
+
+def expand_grid(param_space):
+    """
+    Expands a parameter space into the list of every combination of its values
+
+    Arguments:
+        param_space - Dictionary of model_create argument to list of values to try
+
+    Returns:
+        grid - List of dictionaries of model_create arguments
+
+    """
+    names = list(param_space)
+    return [
+        dict(zip(names, values))
+        for values in itertools.product(*(param_space[name] for name in names))
+    ]
+
+
+def experiment_name(index, params, prefix="exp"):
+    """
+    Builds an mlflow experiment name like exp_12_conv_layers_3_pool_size_2, which run_checker
+    can read the experiment number back from
+    """
+    parts = ["{}_{}".format(prefix, index)]
+    parts.extend("{}_{}".format(name, value) for name, value in params.items())
+    return "_".join(parts)
+
+
+def _init_worker(intra_op_threads, inter_op_threads):
+    """
+    Pins the number of threads used by each worker before TensorFlow is imported, so that
+    the workers together don't ask for more threads than there are cores
+    """
+    for variable in ["OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS"]:
+        os.environ[variable] = str(intra_op_threads)
+
+    import cv2
+    import tensorflow as tf
+
+    cv2.setNumThreads(intra_op_threads)
+    tf.config.threading.set_intra_op_parallelism_threads(intra_op_threads)
+    tf.config.threading.set_inter_op_parallelism_threads(inter_op_threads)
+
+
+def _grid_worker(sender, intra_op_threads, inter_op_threads, args):
+    """
+    Entry point of the process running one point of the grid. Sends back (True, outcome) if the
+    run went through, or (False, error message) if it raised
+    """
+    try:
+        _init_worker(intra_op_threads, inter_op_threads)
+        message = (True, _run_grid_point(*args))
+    except Exception as e:
+        message = (False, "".join(traceback.format_exception_only(type(e), e)).strip())
+    sender.send(message)
+    sender.close()
+
+
+def _fail_open_runs(name):
+    """
+    Marks the runs still open in the experiment of a grid point as failed. A worker process which
+    dies never gets to end its mlflow run, which would otherwise stay RUNNING next to the run of
+    the retry. A retry resuming from a checkpoint reopens its run
+    """
+    client = MlflowClient()
+    experiment = client.get_experiment_by_name(name)
+    if experiment is None:
+        return
+    for run in client.search_runs([experiment.experiment_id]):
+        if run.info.status == "RUNNING":
+            client.set_terminated(run.info.run_id, "FAILED")
+
+
+def _run_grid_point(name, params, df_dict, batch_size, epochs, run_kwargs):
+    """
+    Creates the model for one point of the grid and trains it in its own mlflow experiment
+    """
+    # keras is only imported here, after _init_worker has pinned the threads
+    from model_creator import model_create, BudgetExceededError
+    from experiments import (
+        run_experiment_with_callbacks,
+        run_experiment_without_callbacks,
+    )
+
+    if run_kwargs.get("checkpoint_dir") is not None:
+        # every point of the grid keeps its own checkpoints, which a retry then resumes from
+        run_kwargs = dict(
+            run_kwargs, checkpoint_dir=os.path.join(run_kwargs["checkpoint_dir"], name)
+        )
+
+    start = time.time()
+    try:
+        created = model_create(**params)
+    except BudgetExceededError as e:
+        # over budget configurations are reported back rather than raised, so they aren't retried
+        return {"status": "rejected", "seconds": None, "error": str(e)}
+    # model_create only returns callbacks when early stopping or learning rate reduction is on
+    if isinstance(created, tuple):
+        model, callbacks_list = created
+        run_experiment_with_callbacks(
+            name, model, callbacks_list, batch_size, epochs, df_dict, **run_kwargs
+        )
+    else:
+        run_experiment_without_callbacks(
+            name, created, batch_size, epochs, df_dict, **run_kwargs
+        )
+    return {"status": "finished", "seconds": time.time() - start, "error": None}
+
+
+def run_grid(
+    param_space,
+    df_dict,
+    batch_size=100,
+    epochs=50,
+    n_workers=2,
+    threads_per_worker=None,
+    inter_op_threads=1,
+    retries=1,
+    name_prefix="exp",
+    start_index=1,
+    **run_kwargs
+):
+    """
+    Runs every combination of model_create parameters in param_space, several at a time in
+    separate worker processes. Each point of the grid gets its own mlflow experiment, named by
+    experiment_name, and runs in a fresh process with a fixed number of threads. Failed runs,
+    including ones whose process crashed or was killed, are queued up again up to retries times,
+    resuming from their last checkpoint if a checkpoint_dir is passed on to the runners. The
+    mlflow runs left open by a crashed process are marked as failed. Points whose model is over
+    the max_params or max_flops budget given in param_space are not trained and come back as
+    "rejected"
+
+    If a cache_dir is passed on to the runners, the preprocessed shards are built once up front
+    so that the workers don't all build them at the same time
+
+    Arguments:
+        param_space - Dictionary of model_create argument to list of values to try
+        df_dict - Dictionary of dataframes with at least the "train" dataframe
+        batch_size, epochs - Passed to the experiment runners
+        n_workers - Number of experiments run at the same time
+        threads_per_worker - Intra-op threads per worker, by default the cores split between workers
+        inter_op_threads - Inter-op threads per worker
+        retries - Number of times a failed run is tried again
+        name_prefix, start_index - The first experiment is named {name_prefix}_{start_index}_...
+        run_kwargs - Other arguments of the experiment runners (data_augmentation, cache_dir, ...)
+
+    Returns:
+        results - List with the name, parameters, status (finished, rejected or failed), number of
+            attempts, training time and error (if any) of each point of the grid
+
+    """
+    if threads_per_worker is None:
+        threads_per_worker = max(1, (os.cpu_count() or 1) // n_workers)
+
+    if run_kwargs.get("cache_dir") is not None:
+        label_index = build_label_index(df_dict["train"])
+        for i in range(4):
+            load_processed_shard(
+                "./data/train_image_data_{}.parquet".format(i),
+                label_index,
+                size=run_kwargs.get("size", (118, 68)),
+                cache_dir=run_kwargs["cache_dir"],
+                crop_to_ink=run_kwargs.get("crop_to_ink", False),
+            )
+
+    jobs = [
+        {
+            "name": experiment_name(start_index + k, params, name_prefix),
+            "params": params,
+            "attempts": 0,
+        }
+        for k, params in enumerate(expand_grid(param_space))
+    ]
+
+    # every run gets a fresh process, since keras keeps global state between models. The
+    # processes are watched directly, so a run which crashes (killed for running out of memory,
+    # segfault in tensorflow, ...) is noticed and retried like one which raised
+    ctx = multiprocessing.get_context("spawn")
+
+    def submit(job):
+        job["attempts"] += 1
+        print("Starting {} (attempt {})".format(job["name"], job["attempts"]))
+        receiver, sender = ctx.Pipe(duplex=False)
+        process = ctx.Process(
+            target=_grid_worker,
+            args=(
+                sender,
+                threads_per_worker,
+                inter_op_threads,
+                (job["name"], job["params"], df_dict, batch_size, epochs, run_kwargs),
+            ),
+        )
+        process.start()
+        # only the worker writes to the pipe, closing our end lets recv notice if it dies
+        sender.close()
+        return process, receiver
+
+    results = []
+    queued = list(jobs)
+    running = []
+    try:
+        while queued or running:
+            while queued and len(running) < n_workers:
+                job = queued.pop(0)
+                running.append((job, submit(job)))
+
+            still_running = []
+            for job, (process, receiver) in running:
+                if process.is_alive() and not receiver.poll():
+                    still_running.append((job, (process, receiver)))
+                    continue
+                try:
+                    ok, outcome = receiver.recv()
+                except EOFError:
+                    # the process is gone without sending anything back
+                    ok = False
+                    process.join()
+                    outcome = "Worker process exited with code {}".format(process.exitcode)
+                    _fail_open_runs(job["name"])
+                receiver.close()
+                process.join()
+
+                if ok:
+                    results.append(
+                        {
+                            "name": job["name"],
+                            "params": job["params"],
+                            "status": outcome["status"],
+                            "attempts": job["attempts"],
+                            "seconds": outcome["seconds"],
+                            "error": outcome["error"],
+                        }
+                    )
+                    if outcome["status"] == "rejected":
+                        print("Rejected {} ({})".format(job["name"], outcome["error"]))
+                    else:
+                        print(
+                            "Finished {} in {:.0f}s".format(
+                                job["name"], outcome["seconds"]
+                            )
+                        )
+                elif job["attempts"] <= retries:
+                    print("{} failed ({}), retrying".format(job["name"], outcome))
+                    queued.append(job)
+                else:
+                    results.append(
+                        {
+                            "name": job["name"],
+                            "params": job["params"],
+                            "status": "failed",
+                            "attempts": job["attempts"],
+                            "seconds": None,
+                            "error": outcome,
+                        }
+                    )
+                    print("{} failed ({})".format(job["name"], outcome))
+            running = still_running
+            time.sleep(1)
+    finally:
+        for job, (process, receiver) in running:
+            process.terminate()
+            process.join()
+            receiver.close()
+
+    # putting the results back in grid order
+    order = {job["name"]: k for k, job in enumerate(jobs)}
+    return sorted(results, key=lambda result: order[result["name"]])
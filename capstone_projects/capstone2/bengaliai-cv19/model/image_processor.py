@@ -1,33 +1,127 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
 import cv2
 import numpy as np
-import pandas as pd
 
 
-def image_processor_func(X, resize=True, size=(118, 68)):
+def ink_bounding_box(thresh, padding=0):
+    """
+    Finds the bounding box of the ink (the black pixels) of a thresholded image with a reduction
+    over its rows and one over its columns, grown by padding pixels on every side and clipped to
+    the image. An image without any ink keeps its full canvas
+
+    Returns:
+        top, bottom, left, right - Bounds of the box, to be used as thresh[top:bottom, left:right]
+
+    """
+    height, width = thresh.shape
+    ink = thresh < 128
+    rows = np.flatnonzero(ink.any(axis=1))
+    if len(rows) == 0:
+        return 0, height, 0, width
+    cols = np.flatnonzero(ink.any(axis=0))
+    return (
+        max(rows[0] - padding, 0),
+        min(rows[-1] + 1 + padding, height),
+        max(cols[0] - padding, 0),
+        min(cols[-1] + 1 + padding, width),
+    )
+
+
+def _process_range(X, Xout, start, stop, resize, size, crop_to_ink, crop_padding):
+    """
+    Worker for image_processor_func. Thresholds (crops and resizes) images start to stop - 1 and
+    writes them straight into the matching rows of the preallocated output array
+    """
+    for i in range(start, stop):
+        # cv2 can write into a view of the output row directly, so no per image array is kept
+        if resize:
+            ret, thresh = cv2.threshold(
+                X[i], 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU
+            )
+            if crop_to_ink:
+                # the crop is only a view, cv2.resize reads it in place
+                top, bottom, left, right = ink_bounding_box(thresh, crop_padding)
+                thresh = thresh[top:bottom, left:right]
+            cv2.resize(
+                thresh,
+                size,
+                dst=Xout[i].reshape(size[1], size[0]),
+                interpolation=cv2.INTER_AREA,
+            )
+        else:
+            cv2.threshold(
+                X[i],
+                0,
+                255,
+                cv2.THRESH_BINARY + cv2.THRESH_OTSU,
+                dst=Xout[i].reshape(X.shape[1], X.shape[2]),
+            )
+
+
+def image_processor_func(
+    X, resize=True, size=(118, 68), n_jobs=None, crop_to_ink=False, crop_padding=4
+):
     """
     This function applies threshold filters and resizes images if resize flag is true.
-    By default the function 
+    By default the function compresses the images to half the original resolution.
+
+    If crop_to_ink is true, each thresholded image is first cropped to the bounding box of its
+    ink plus crop_padding pixels, so the blank margins aren't carried into the resized image and
+    smaller sizes (such as 64x64) keep the detail of the grapheme. Cropping needs resize
+
+    The images are split into one contiguous range per worker. OpenCV releases the GIL, so a
+    thread pool is enough to keep all the cores busy
 
     Inputs
     ------
-    X -  Image dataframe
-    size - New size of images
+    X -  uint8 image array of shape (n_images, height, width) or (n_images, height, width, 1)
+    size - New size of images as (width, height)
+    n_jobs - Number of worker threads, defaults to the number of cores
+    crop_to_ink - Whether to crop the images to their ink before resizing
+    crop_padding - Number of pixels (at the original resolution) kept around the ink
 
     Outputs
     -------
-    Xoutdf - Output image dataframe post thresholding and resizing
-    
+    Xout - uint8 array of shape (n_images, new height * new width) post thresholding and resizing
+
     """
+    if crop_to_ink and not resize:
+        raise ValueError("crop_to_ink needs resize, so that every image has the same size")
+    X = np.asarray(X, dtype=np.uint8)
     X_length = X.shape[0]
-    Xout = {}
-    for i in range(X_length):
-        image = X[i]
-        ret, thresh = cv2.threshold(image, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
-        if resize:
-            resized_image = cv2.resize(thresh, size, interpolation=cv2.INTER_AREA)
-            Xout[i] = resized_image.reshape(-1)
-        else:
-            Xout[i] = thresh.reshape(-1)
+    if resize:
+        n_pixels = size[0] * size[1]
+    else:
+        n_pixels = X.shape[1] * X.shape[2]
+    Xout = np.empty((X_length, n_pixels), dtype=np.uint8)
+
+    if n_jobs is None:
+        n_jobs = os.cpu_count() or 1
+    n_jobs = max(1, min(n_jobs, X_length))
+
+    bounds = np.linspace(0, X_length, n_jobs + 1).astype(int)
+    if n_jobs == 1:
+        _process_range(
+            X, Xout, 0, X_length, resize, size, crop_to_ink, crop_padding
+        )
+    else:
+        with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+            futures = [
+                executor.submit(
+                    _process_range,
+                    X,
+                    Xout,
+                    bounds[k],
+                    bounds[k + 1],
+                    resize,
+                    size,
+                    crop_to_ink,
+                    crop_padding,
+                )
+                for k in range(n_jobs)
+            ]
+            for future in futures:
+                future.result()
 
-    Xoutdf = pd.DataFrame(Xout).T
-    return Xoutdf
+    return Xout
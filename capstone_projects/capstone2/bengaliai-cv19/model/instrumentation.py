@@ -0,0 +1,153 @@
+import os
+import json
+import time
+import threading
+import resource
+import tracemalloc
+from contextlib import contextmanager
+from collections import defaultdict
+import mlflow
+
+
+def current_rss_mb():
+    """
+    Returns the resident memory of this process in MB. Read from /proc on linux, elsewhere it falls
+    back to the peak resident memory, which is the closest thing the standard library offers
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            resident_pages = int(f.read().split()[1])
+        return resident_pages * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except (OSError, ValueError):
+        return peak_rss_mb()
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on linux and in bytes on macOS
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss / 2 ** 20 if os.uname().sysname == "Darwin" else maxrss / 2 ** 10
+
+
+class StageProfiler:
+    """
+    Lightweight timer for the stages of an experiment (parquet read, threshold/resize,
+    normalization, augmentation, model.fit, ...). Each stage is wrapped in a context manager which
+    records its wall time along with the resident memory before and after it and, if trace_memory
+    is true, the change in memory allocated by Python as seen by tracemalloc
+
+    Records are tagged with the current shard, can be logged to mlflow as metrics (one step per shard)
+    and exported as a Chrome trace (open it in chrome://tracing or Perfetto). A disabled profiler
+    records nothing, so it can be passed around unconditionally
+
+    Arguments:
+        enabled - Whether to record anything
+        trace_memory - Also follow Python allocations with tracemalloc, which slows things down
+
+    """
+
+    def __init__(self, enabled=True, trace_memory=False):
+        self.enabled = enabled
+        self.trace_memory = trace_memory and enabled
+        self.shard = None
+        self.records = []
+        self._origin = time.time()
+        self._lock = threading.Lock()
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def __getstate__(self):
+        # locks can't be pickled, a copy sent to another process keeps its own records
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name):
+        if not self.enabled:
+            yield
+            return
+
+        shard = self.shard
+        rss_start = current_rss_mb()
+        traced_start = tracemalloc.get_traced_memory()[0] if self.trace_memory else 0
+        start = time.time()
+        try:
+            yield
+        finally:
+            end = time.time()
+            record = {
+                "name": name,
+                "shard": shard,
+                "start": start - self._origin,
+                "seconds": end - start,
+                "rss_start_mb": rss_start,
+                "rss_end_mb": current_rss_mb(),
+                "peak_rss_mb": peak_rss_mb(),
+                "thread": threading.get_ident(),
+            }
+            if self.trace_memory:
+                traced_end = tracemalloc.get_traced_memory()[0]
+                record["traced_change_mb"] = (traced_end - traced_start) / 2 ** 20
+            with self._lock:
+                self.records.append(record)
+
+    def summary(self):
+        """
+        Returns the records added up per shard and stage, as a dictionary of
+        (shard, stage name) to total seconds, number of calls and largest resident memory
+        """
+        totals = defaultdict(lambda: {"seconds": 0.0, "calls": 0, "rss_mb": 0.0})
+        with self._lock:
+            records = list(self.records)
+        for record in records:
+            total = totals[(record["shard"], record["name"])]
+            total["seconds"] += record["seconds"]
+            total["calls"] += 1
+            total["rss_mb"] = max(total["rss_mb"], record["rss_end_mb"])
+        return dict(totals)
+
+    def log_to_mlflow(self):
+        """
+        Logs the total time and resident memory of each stage to the active mlflow run, as
+        stage_{name}_seconds and stage_{name}_rss_mb with the shard number as the step
+        """
+        if not self.enabled:
+            return
+        for (shard, name), total in sorted(
+            self.summary().items(), key=lambda item: (item[0][0] or 0, item[0][1])
+        ):
+            step = shard or 0
+            mlflow.log_metric("stage_{}_seconds".format(name), total["seconds"], step=step)
+            mlflow.log_metric("stage_{}_rss_mb".format(name), total["rss_mb"], step=step)
+        mlflow.log_metric("peak_rss_mb", peak_rss_mb())
+
+    def export_chrome_trace(self, path):
+        """
+        Writes the records to path in the Chrome trace event format
+        """
+        pid = os.getpid()
+        with self._lock:
+            records = list(self.records)
+        events = [
+            {
+                "name": record["name"],
+                "cat": "stage",
+                "ph": "X",
+                "ts": record["start"] * 1e6,
+                "dur": record["seconds"] * 1e6,
+                "pid": pid,
+                "tid": record["thread"],
+                "args": {
+                    key: value
+                    for key, value in record.items()
+                    if key not in ("name", "start", "seconds", "thread")
+                },
+            }
+            for record in records
+        ]
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
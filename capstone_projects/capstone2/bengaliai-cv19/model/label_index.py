@@ -0,0 +1,60 @@
+import hashlib
+import numpy as np
+import pandas as pd
+
+# order of the target columns in every label array returned by this module
+LABEL_COLUMNS = ["grapheme_root", "vowel_diacritic", "consonant_diacritic"]
+
+
+def build_label_index(train_df):
+    """
+    Builds the label index once from train.csv. The three targets are stored as int16 class ids
+    (168 roots, 11 vowels and 7 consonants all fit comfortably) and indexed by image_id, so the
+    labels of any shard can be looked up without merging or one hot encoding
+
+    Arguments:
+        train_df - Dataframe read from train.csv
+
+    Returns:
+        label_index - Dataframe indexed by image_id with one int16 column per target
+
+    """
+    label_index = train_df.set_index("image_id")[LABEL_COLUMNS].astype(np.int16)
+    return label_index
+
+
+def as_label_index(df):
+    """
+    Returns df unchanged if it is already a label index, otherwise builds one from it
+    """
+    if "image_id" in df.columns:
+        return build_label_index(df)
+    return df
+
+
+def label_fingerprint(label_index):
+    """
+    Returns a short hash of the image ids and class ids of a label index, so that anything built
+    from the labels (such as the entries of shard_cache) can tell when train.csv changed
+    """
+    row_hashes = pd.util.hash_pandas_object(label_index[LABEL_COLUMNS], index=True)
+    return hashlib.sha1(row_hashes.values.tobytes()).hexdigest()
+
+
+def lookup_labels(label_index, image_ids):
+    """
+    Looks up the class ids of the given images
+
+    Arguments:
+        label_index - Label index from build_label_index
+        image_ids - Sequence of image ids
+
+    Returns:
+        labels - int16 array of shape (n_images, 3) with the columns in LABEL_COLUMNS order
+
+    """
+    positions = label_index.index.get_indexer(image_ids)
+    if (positions < 0).any():
+        missing = np.asarray(image_ids)[positions < 0]
+        raise KeyError("No labels found for image ids {}".format(list(missing[:5])))
+    return label_index.values[positions]
@@ -7,6 +7,9 @@ from keras.layers import (
     Dropout,
     BatchNormalization,
     Input,
+    Lambda,
+    SeparableConv2D,
+    GlobalAveragePooling2D,
 )
 from keras.optimizers import Adam
 from keras.utils import plot_model
@@ -15,6 +18,102 @@ from keras import initializers
 from keras.callbacks import EarlyStopping, ReduceLROnPlateau
 
 
+class BudgetExceededError(ValueError):
+    """
+    Raised by model_create when a configuration is over its parameter or FLOP budget
+    """
+
+
+def _scale_width(count, width_multiplier):
+    return max(1, int(round(count * width_multiplier)))
+
+
+def estimate_cost(model):
+    """
+    Estimates the number of parameters and the FLOPs needed to run one image through a model,
+    counting a multiply-add as 2 FLOPs. Only the convolutional and dense layers are counted,
+    since pooling, batch normalization and activations are small next to them
+
+    Arguments:
+        model - Keras model
+
+    Returns:
+        cost - Dictionary with the "params" and "flops" of the model, and the "flops" of each
+            counted layer under "layers"
+
+    """
+    layers = {}
+    for layer in model.layers:
+        if isinstance(layer, SeparableConv2D):
+            _, out_h, out_w, out_c = layer.output_shape
+            in_c = layer.input_shape[-1]
+            kernel_h, kernel_w = layer.kernel_size
+            depthwise = in_c * layer.depth_multiplier
+            # a depthwise pass over each input channel, then a 1x1 convolution across channels
+            flops = out_h * out_w * depthwise * (kernel_h * kernel_w + out_c)
+        elif isinstance(layer, Conv2D):
+            _, out_h, out_w, out_c = layer.output_shape
+            in_c = layer.input_shape[-1]
+            kernel_h, kernel_w = layer.kernel_size
+            flops = out_h * out_w * out_c * kernel_h * kernel_w * in_c
+        elif isinstance(layer, Dense):
+            flops = layer.input_shape[-1] * layer.units
+        else:
+            continue
+        layers[layer.name] = 2 * int(flops)
+    return {
+        "params": int(model.count_params()),
+        "flops": sum(layers.values()),
+        "layers": layers,
+    }
+
+
+def check_budget(model, max_params=None, max_flops=None):
+    """
+    Raises a BudgetExceededError if the model has more parameters than max_params or needs more
+    FLOPs per image than max_flops, and otherwise returns its estimate_cost
+    """
+    cost = estimate_cost(model)
+    if max_params is not None and cost["params"] > max_params:
+        raise BudgetExceededError(
+            "{:,} parameters is over the budget of {:,}".format(
+                cost["params"], max_params
+            )
+        )
+    if max_flops is not None and cost["flops"] > max_flops:
+        raise BudgetExceededError(
+            "{:,} FLOPs per image is over the budget of {:,}".format(
+                cost["flops"], max_flops
+            )
+        )
+    return cost
+
+
+def check_input_scaling(model, normalize):
+    """
+    Makes sure a trained model is fed images on the scale it was trained on. Models with the
+    input_rescale layer take the uint8 images as they are, while models created with
+    rescale_input=False (and every model saved before rescale_input was added) need normalize.
+    Models without keras layers, such as quantizer.TFLiteModel, aren't checked
+
+    Raises:
+        ValueError - If normalize doesn't match the model
+
+    """
+    if not hasattr(model, "layers"):
+        return
+    rescales = any(layer.name == "input_rescale" for layer in model.layers)
+    if rescales and normalize:
+        raise ValueError(
+            "The model rescales its own inputs (input_rescale layer), use normalize=False"
+        )
+    if not rescales and not normalize:
+        raise ValueError(
+            "The model has no input_rescale layer and expects images scaled to [0, 1], use "
+            "normalize=True (this is the case for models saved before rescale_input was added)"
+        )
+
+
 def model_create(
     input_shape=(137, 236, 1),
     n_conv_layers=3,
@@ -32,6 +131,13 @@ def model_create(
     bn_momentum=0.99,
     early_stopping=False,
     learningrate_reduction=False,
+    rescale_input=True,
+    reset_session=True,
+    conv_type="standard",
+    head="dense",
+    width_multiplier=1.0,
+    max_params=None,
+    max_flops=None,
 ):
 
     """
@@ -40,51 +146,81 @@ def model_create(
     i.e grapheme root, vowel diacritic and consonant diacritic
     
     This uses the Keras Functional API
+
+    If rescale_input is true, the first layer scales the pixel values by 1/255, so the model can be
+    fed the uint8 images directly and each batch is only converted to float32 as it is used
+
+    The keras session is cleared first unless reset_session is false, which is needed to keep
+    several models alive at once (see run_experiment_multi_model)
+
+    Lighter variants of the network can be built with:
+        conv_type - "standard" convolutions or depthwise-"separable" ones
+        head - "dense" for the Flatten and 2 dense layers, or "gap" for a global average pooling
+            head which feeds the output layers directly (dense_layer1_count and
+            dense_layer2_count are then unused)
+        width_multiplier - Scales the number of filters and dense units of every layer
+        max_params, max_flops - Compute budget, a model with more parameters or FLOPs per image
+            (see estimate_cost) raises a BudgetExceededError
     """
-    clear_session()
+    if reset_session:
+        clear_session()
     callbacks_list = []
     inputs = Input(shape=input_shape, name="input_layer")
+    if rescale_input:
+        # normalizing inside the model means the training data can stay as uint8 in memory
+        scaled_inputs = Lambda(lambda x: x / 255.0, name="input_rescale")(inputs)
+    else:
+        scaled_inputs = inputs
+    # the width multiplier scales every layer of the network, like the alpha of MobileNet
+    conv_nfilters = _scale_width(conv_nfilters, width_multiplier)
+    dense_layer1_count = _scale_width(dense_layer1_count, width_multiplier)
+    dense_layer2_count = _scale_width(dense_layer2_count, width_multiplier)
+    if conv_type == "standard":
+        conv_layer = Conv2D
+    elif conv_type == "separable":
+        # depthwise-separable convolutions need about 1/kernel_size**2 of the multiply-adds
+        conv_layer = SeparableConv2D
+    else:
+        raise ValueError("Unknown conv_type {}".format(conv_type))
+
+    model = scaled_inputs
     for i in range(n_conv_layers):
         # create alternating convolutional and pooling layers
-        if i == 0:
-            model = Conv2D(
-                filters=conv_nfilters,
-                kernel_size=(conv_kernel_size, conv_kernel_size),
-                padding="SAME",
-                strides=n_strides,
-                activation=activation_conv,
-                input_shape=input_shape,
-            )(inputs)
-
-        else:
-            model = Conv2D(
-                filters=conv_nfilters,
-                kernel_size=(conv_kernel_size, conv_kernel_size),
-                padding="SAME",
-                strides=n_strides,
-                activation=activation_conv,
-                input_shape=input_shape,
-            )(model)
-
+        model = conv_layer(
+            filters=conv_nfilters,
+            kernel_size=(conv_kernel_size, conv_kernel_size),
+            padding="SAME",
+            strides=n_strides,
+            activation=activation_conv,
+        )(model)
         model = MaxPool2D(pool_size=(pool_size, pool_size))(model)
     # creating dropout layer with a dropout rate corresponding to dropout_rate1
     model = Dropout(rate=dropout_rate1)(model)
-    # flattening network for input into dense layer
-    model = Flatten()(model)
-    # doing batch normalization prior to dense layer
-    model = BatchNormalization(momentum=bn_momentum)(model)
-    # defining dense layer with a count defined by dense_layer1_count
-    model = Dense(
-        dense_layer1_count, activation=activation_dense, name="first_dense_layer",
-    )(model)
-    # creating dropout layer with a dropout rate corresponding to dropout_rate2
-    model = Dropout(rate=dropout_rate2)(model)
-    # creating another batch normalization layer
-    model = BatchNormalization(momentum=bn_momentum)(model)
-    # creating a final dense layer before output layers
-    dense = Dense(
-        dense_layer2_count, activation=activation_dense, name="second_dense_layer",
-    )(model)
+    if head == "dense":
+        # flattening network for input into dense layer
+        model = Flatten()(model)
+        # doing batch normalization prior to dense layer
+        model = BatchNormalization(momentum=bn_momentum)(model)
+        # defining dense layer with a count defined by dense_layer1_count
+        model = Dense(
+            dense_layer1_count, activation=activation_dense, name="first_dense_layer",
+        )(model)
+        # creating dropout layer with a dropout rate corresponding to dropout_rate2
+        model = Dropout(rate=dropout_rate2)(model)
+        # creating another batch normalization layer
+        model = BatchNormalization(momentum=bn_momentum)(model)
+        # creating a final dense layer before output layers
+        dense = Dense(
+            dense_layer2_count, activation=activation_dense, name="second_dense_layer",
+        )(model)
+    elif head == "gap":
+        # averaging each feature map down to a single value, so the head no longer grows with
+        # the size of the last feature maps and the output layers sit directly on top of it
+        model = GlobalAveragePooling2D()(model)
+        model = BatchNormalization(momentum=bn_momentum)(model)
+        dense = Dropout(rate=dropout_rate2)(model)
+    else:
+        raise ValueError("Unknown head {}".format(head))
     # creating separate output layers for the grapheme roots (168 nodes), vowel diacritics (11 nodes) and consonant diacritics (7 nodes)
     out_root = Dense(168, activation=activation_out, name="output_root")(dense)
     out_vowel = Dense(11, activation=activation_out, name="output_vowel")(dense)
@@ -92,8 +228,11 @@ def model_create(
 
     # putting our model together ...
     model = Model(inputs=inputs, outputs=[out_root, out_vowel, out_consonant])
+    # configurations over the compute budget are rejected before anything is compiled or trained
+    check_budget(model, max_params=max_params, max_flops=max_flops)
+    # the targets are integer class ids, so we use the sparse version of the categorical loss
     model.compile(
-        optimizer="adam", loss="categorical_crossentropy", metrics=["accuracy"]
+        optimizer="adam", loss="sparse_categorical_crossentropy", metrics=["accuracy"]
     )
     if early_stopping:
         es_root = EarlyStopping(
@@ -1,53 +1,124 @@
-import pandas as pd
-import numpy as np
-import matplotlib.pyplot as plt
 import os
-from run_checker import metrics_trends
+import multiprocessing
+import matplotlib
+
+# rendering straight to png files, no display needed (this has to come before pyplot)
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt
+from run_checker import MLRUNS_PATH, scan_mlruns, load_metrics_trends, pivot_trends
 
 
-def plot_and_save(model_list):
+def _render_model(model, trends, output_path):
+    """
+    Draws the 2x2 training/validation accuracy and loss figure of one model and saves it to
+    output_path. Runs in the worker processes of plot_and_save
+    """
     plt.style.use("seaborn-bright")
     plot_dict = {0: "output_", 1: "val_output_"}
     title_dict = {0: "training_set_", 1: "validation_set_"}
     label_dict = {0: "accuracy", 1: "loss"}
+
+    fig, axes = plt.subplots(nrows=2, ncols=2, sharex=True, figsize=(10, 6))
+
+    for idx, ax in enumerate(axes):
+        for plot_num in range(2):
+            ax[plot_num].plot(
+                trends["cumtime"],
+                trends[plot_dict[idx] + "vowel_" + label_dict[plot_num]],
+                label="vowel",
+            )
+            ax[plot_num].plot(
+                trends["cumtime"],
+                trends[plot_dict[idx] + "root_" + label_dict[plot_num]],
+                label="root",
+            )
+            ax[plot_num].plot(
+                trends["cumtime"],
+                trends[plot_dict[idx] + "consonant_" + label_dict[plot_num]],
+                label="consonant",
+            )
+            ax[plot_num].set_ylabel(label_dict[plot_num] + " (-)")
+            ax[plot_num].set_title(title_dict[idx] + label_dict[plot_num])
+            ax[plot_num].legend(loc="center right")
+            if idx == 0:
+                ax[plot_num].tick_params(axis="x", which="both", bottom=False, top=False)
+
+    fig.suptitle("Training Trends for Model #{}".format(model))
+
+    fig.savefig(output_path)
+    # pyplot keeps every figure alive until it is closed
+    plt.close(fig)
+    return output_path
+
+
+def _latest_metric_mtimes(index):
+    """
+    Returns the modification time of the most recently written metric file of each model
+    """
+    mtimes = {}
+    for run in index["runs"].values():
+        if run["experiment_number"] is None or not run["metrics"]:
+            continue
+        model = int(run["experiment_number"])
+        latest = max(info["mtime"] for info in run["metrics"].values())
+        mtimes[model] = max(mtimes.get(model, 0), latest)
+    return mtimes
+
+
+def plot_and_save(model_list, output_dir=".", filepath=MLRUNS_PATH, n_workers=None, force=False):
+    """
+    Renders the training trends figure (model_{number}_eval.png) of every model in model_list.
+    Figures are only redrawn when one of the model's metric files changed after its png was
+    written (unless force is true), and the ones that need it are drawn in parallel by a pool of
+    processes
+
+    Arguments:
+        model_list - List of model (experiment) numbers
+        output_dir - Folder to save the png files to
+        filepath - Location of mlruns folder
+        n_workers - Number of processes drawing figures, defaults to the number of cores
+        force - Redraw every figure
+
+    Returns:
+        written - List of the png files which were (re)drawn
+
+    """
+    # the run index records the modification time of every metric file
+    metric_mtimes = _latest_metric_mtimes(scan_mlruns(filepath))
+
+    stale = []
     for model in model_list:
-        trends = metrics_trends(model)
-        os.chdir(
-            "/home/jayanth/Documents/springboard/capstone_projects/capstone2/bengaliai-cv19/"
-        )
-
-        fig, axes = plt.subplots(nrows=2, ncols=2, sharex=True, figsize=(10, 6))
-
-        for idx, ax in enumerate(axes):
-            for plot_num in range(2):
-                ax[plot_num].plot(
-                    trends["cumtime"],
-                    trends[plot_dict[idx] + "vowel_" + label_dict[plot_num]],
-                    label="vowel",
-                )
-                ax[plot_num].plot(
-                    trends["cumtime"],
-                    trends[plot_dict[idx] + "root_" + label_dict[plot_num]],
-                    label="root",
-                )
-                ax[plot_num].plot(
-                    trends["cumtime"],
-                    trends[plot_dict[idx] + "consonant_" + label_dict[plot_num]],
-                    label="consonant",
-                )
-                ax[plot_num].set_ylabel(label_dict[plot_num] + " (-)")
-                ax[plot_num].set_title(title_dict[idx] + label_dict[plot_num])
-                ax[plot_num].legend(loc="center right")
-                if idx == 0:
-                    ax[plot_num].tick_params(
-                        axis="x", which="both", bottom=False, top=False
-                    )
-
-        fig.suptitle("Training Trends for Model #{}".format(model))
-
-        plt.savefig("model_{}_eval.png".format(model))
-
-
-model_list = [57, 33, 56, 60, 63, 55]
-
-plot_and_save(model_list)
+        output_path = os.path.join(output_dir, "model_{}_eval.png".format(model))
+        if model not in metric_mtimes:
+            print("No metrics found for model #{}".format(model))
+            continue
+        if (
+            not force
+            and os.path.exists(output_path)
+            and os.path.getmtime(output_path) >= metric_mtimes[model]
+        ):
+            continue
+        stale.append((model, output_path))
+    if not stale:
+        return []
+
+    # the trends of the models to draw are loaded in one go
+    all_trends = load_metrics_trends([model for model, _ in stale], filepath)
+    jobs = [
+        (model, pivot_trends(all_trends[all_trends["experiment_number"] == model]), path)
+        for model, path in stale
+    ]
+
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+    n_workers = min(n_workers, len(jobs))
+    if n_workers <= 1:
+        return [_render_model(*job) for job in jobs]
+    with multiprocessing.get_context("spawn").Pool(n_workers) as pool:
+        return pool.starmap(_render_model, jobs)
+
+
+if __name__ == "__main__":
+    model_list = [57, 33, 56, 60, 63, 55]
+
+    plot_and_save(model_list)
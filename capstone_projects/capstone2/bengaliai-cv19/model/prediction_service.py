@@ -0,0 +1,453 @@
+"""
+Local prediction service around a trained model.
+
+The model is loaded once and scores raw 137x236 images sent over localhost HTTP. Concurrent
+requests are grouped into micro-batches: the batcher waits at most max_delay_ms after the first
+waiting request for others to join it, up to max_batch_size images, and runs them through the
+model together. Latency percentiles and throughput are served on /stats
+
+Endpoints:
+    POST /predict - Body of n*137*236 raw uint8 pixels (application/octet-stream), returns the
+        predicted grapheme_root, vowel_diacritic and consonant_diacritic of each image as json
+    GET /stats - Latency (p50/p99) and throughput since the service started
+    GET /health - Returns ok
+
+Usage (from the project folder):
+    python model/prediction_service.py --model model.h5 --port 8080
+"""
+import sys
+import json
+import time
+import queue
+import argparse
+import threading
+import socketserver
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.request import Request, urlopen
+import numpy as np
+from image_processor import image_processor_func
+
+HEIGHT = 137
+WIDTH = 236
+# order of the model outputs
+COMPONENTS = ["grapheme_root", "vowel_diacritic", "consonant_diacritic"]
+
+
+class LatencyStats:
+    """
+    Keeps the latencies of the most recent requests along with running totals, and summarizes
+    them as percentiles and throughput
+    """
+
+    def __init__(self, window=10000):
+        self.latencies = deque(maxlen=window)
+        self.batch_sizes = deque(maxlen=window)
+        self.n_requests = 0
+        self.n_images = 0
+        self.start = time.time()
+        self._lock = threading.Lock()
+
+    def add_request(self, latency, n_images):
+        with self._lock:
+            self.latencies.append(latency)
+            self.n_requests += 1
+            self.n_images += n_images
+
+    def add_batch(self, n_images):
+        with self._lock:
+            self.batch_sizes.append(n_images)
+
+    def summary(self):
+        with self._lock:
+            latencies = np.array(self.latencies) * 1000
+            batch_sizes = np.array(self.batch_sizes)
+            n_requests, n_images = self.n_requests, self.n_images
+        seconds = time.time() - self.start
+        summary = {
+            "requests": n_requests,
+            "images": n_images,
+            "seconds": seconds,
+            "requests_per_sec": n_requests / seconds,
+            "images_per_sec": n_images / seconds,
+        }
+        if len(latencies):
+            summary["p50_ms"] = float(np.percentile(latencies, 50))
+            summary["p99_ms"] = float(np.percentile(latencies, 99))
+        if len(batch_sizes):
+            summary["mean_batch_size"] = float(batch_sizes.mean())
+        return summary
+
+
+class MicroBatcher:
+    """
+    Groups the images of concurrent requests into batches for a single predict call. Requests
+    are queued by submit and picked up by one background thread, which is also the only thread
+    that ever touches the model
+
+    Arguments:
+        predict_func - Function from a batch of images to a list of per image output arrays
+        max_batch_size - Largest number of images in a batch
+        max_delay_ms - Longest time the first request of a batch waits for others to join it
+        stats - LatencyStats the request latencies are added to
+
+    """
+
+    def __init__(self, predict_func, max_batch_size=64, max_delay_ms=5, stats=None):
+        self.predict_func = predict_func
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay_ms / 1000
+        self.stats = stats if stats is not None else LatencyStats()
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, images):
+        """
+        Queues a batch of preprocessed images and returns a Future of their outputs
+        """
+        future = Future()
+        self._queue.put((images, future, time.time()))
+        return future
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+
+    def _collect(self):
+        # blocks for the first request, then takes whatever else arrives before the deadline
+        first = self._queue.get()
+        if first is None:
+            return None
+        requests = [first]
+        n_images = len(first[0])
+        deadline = time.time() + self.max_delay
+        while n_images < self.max_batch_size:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                request = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if request is None:
+                # finishing this batch before stopping
+                self._queue.put(None)
+                break
+            requests.append(request)
+            n_images += len(request[0])
+        return requests
+
+    def _run(self):
+        while True:
+            requests = self._collect()
+            if requests is None:
+                return
+            images = np.concatenate([request[0] for request in requests])
+            self.stats.add_batch(len(images))
+            try:
+                outputs = self.predict_func(images)
+            except Exception as e:
+                for _, future, _ in requests:
+                    future.set_exception(e)
+                continue
+            # handing every request back its own rows of the outputs
+            start = 0
+            for request_images, future, submitted in requests:
+                stop = start + len(request_images)
+                future.set_result([output[start:stop] for output in outputs])
+                self.stats.add_request(time.time() - submitted, len(request_images))
+                start = stop
+
+
+class PredictionService:
+    """
+    Holds the model and the micro-batcher. Raw images are thresholded and resized the same way
+    as during training before they are queued
+
+    Arguments:
+        model - Trained model_create model, or anything with the same predict method
+            (e.g. quantizer.TFLiteModel)
+        size - Size the images were resized to during training, as (width, height)
+        crop_to_ink, crop_padding - Crop settings the model was trained with
+        normalize - Scale the images to [0, 1], for models created without rescale_input. Keras
+            models are checked against it like in tester.test_func
+        max_batch_size, max_delay_ms - Passed to MicroBatcher
+
+    """
+
+    def __init__(
+        self,
+        model,
+        size=(118, 68),
+        crop_to_ink=False,
+        crop_padding=4,
+        normalize=False,
+        max_batch_size=64,
+        max_delay_ms=5,
+    ):
+        self.model = model
+        self.size = size
+        self.crop_to_ink = crop_to_ink
+        self.crop_padding = crop_padding
+        self.normalize = normalize
+        self.max_batch_size = max_batch_size
+        self.stats = LatencyStats()
+
+        if hasattr(model, "layers"):
+            # keras is only imported for keras models, not for TFLite ones
+            from model_creator import check_input_scaling
+
+            check_input_scaling(model, normalize)
+
+        self._session = None
+        if hasattr(model, "_make_predict_function"):
+            # on TensorFlow 1.x, keras models can only predict from another thread with the
+            # predict function built up front and the session and graph they were built in
+            from keras import backend as K
+
+            model._make_predict_function()
+            self._session = K.get_session()
+
+        self.batcher = MicroBatcher(
+            self._predict_batch, max_batch_size, max_delay_ms, self.stats
+        )
+
+    def _predict_batch(self, images):
+        if self._session is None:
+            return self.model.predict(images, batch_size=self.max_batch_size)
+        with self._session.as_default(), self._session.graph.as_default():
+            return self.model.predict(images, batch_size=self.max_batch_size)
+
+    def preprocess(self, pixels):
+        X = image_processor_func(
+            np.asarray(pixels, dtype=np.uint8).reshape(-1, HEIGHT, WIDTH),
+            resize=True,
+            size=self.size,
+            n_jobs=1,
+            crop_to_ink=self.crop_to_ink,
+            crop_padding=self.crop_padding,
+        )
+        X = X.reshape(-1, self.size[1], self.size[0], 1)
+        if self.normalize:
+            X = np.multiply(X, 1 / 255, dtype=np.float32)
+        return X
+
+    def predict(self, pixels):
+        """
+        Scores one image or a small batch of raw images
+
+        Arguments:
+            pixels - uint8 array of shape (137, 236) or (n_images, 137, 236), or the same pixels
+                flattened
+
+        Returns:
+            predictions - Dictionary of component name to a list of class ids, one per image
+
+        """
+        outputs = self.batcher.submit(self.preprocess(pixels)).result()
+        return {
+            component: np.argmax(output, axis=1).tolist()
+            for component, output in zip(COMPONENTS, outputs)
+        }
+
+    def close(self):
+        self.batcher.close()
+
+
+class _ThreadingServer(socketserver.ThreadingMixIn, HTTPServer):
+    # one thread per connection, so that concurrent requests can meet in the micro-batcher
+    daemon_threads = True
+    # the default backlog of 5 resets connections as soon as a few clients connect at once
+    request_queue_size = 128
+
+
+def _make_handler(service):
+    class Handler(BaseHTTPRequestHandler):
+        def _send_json(self, status, payload):
+            body = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == "/stats":
+                self._send_json(200, service.stats.summary())
+            elif self.path == "/health":
+                self._send_json(200, {"status": "ok"})
+            else:
+                self._send_json(404, {"error": "unknown path {}".format(self.path)})
+
+        def do_POST(self):
+            if self.path != "/predict":
+                self._send_json(404, {"error": "unknown path {}".format(self.path)})
+                return
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            if not body or len(body) % (HEIGHT * WIDTH):
+                self._send_json(
+                    400,
+                    {"error": "expected a multiple of {} pixels".format(HEIGHT * WIDTH)},
+                )
+                return
+            try:
+                predictions = service.predict(np.frombuffer(body, dtype=np.uint8))
+            except Exception as e:
+                self._send_json(500, {"error": "{}: {}".format(type(e).__name__, e)})
+                return
+            self._send_json(200, predictions)
+
+        def log_message(self, format, *args):
+            # one line per request would drown out everything else
+            pass
+
+    return Handler
+
+
+def serve(service, host="127.0.0.1", port=8080):
+    """
+    Starts serving a PredictionService over HTTP in a background thread
+
+    Returns:
+        server - The running server, stop it with server.shutdown()
+
+    """
+    server = _ThreadingServer((host, port), _make_handler(service))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+class InProcessClient:
+    """
+    Client stub which calls a PredictionService directly, going through the same preprocessing and
+    micro-batching as HTTP requests without any sockets
+    """
+
+    def __init__(self, service):
+        self.service = service
+
+    def predict(self, pixels):
+        return self.service.predict(pixels)
+
+
+class HTTPClient:
+    """
+    Client for a service started with serve
+    """
+
+    def __init__(self, url="http://127.0.0.1:8080"):
+        self.url = url.rstrip("/")
+
+    def predict(self, pixels):
+        request = Request(
+            self.url + "/predict",
+            data=np.ascontiguousarray(pixels, dtype=np.uint8).tobytes(),
+            headers={"Content-Type": "application/octet-stream"},
+        )
+        with urlopen(request) as response:
+            return json.loads(response.read().decode())
+
+    def stats(self):
+        with urlopen(self.url + "/stats") as response:
+            return json.loads(response.read().decode())
+
+
+def load_test(client, images, n_requests=1000, concurrency=16, images_per_request=1):
+    """
+    Sends n_requests requests of images_per_request images each, concurrency at a time, and
+    measures the latency seen by the client
+
+    Arguments:
+        client - InProcessClient or HTTPClient
+        images - Pool of raw uint8 images of shape (n_images, 137, 236) to send
+        n_requests - Number of requests
+        concurrency - Number of requests in flight at the same time
+        images_per_request - Number of images per request
+
+    Returns:
+        results - Dictionary with the p50/p99 latency in ms and the requests and images per second
+
+    """
+    # drawn up front, a RandomState shouldn't be shared between the threads
+    requests = np.random.RandomState(0).randint(
+        0, len(images), (n_requests, images_per_request)
+    )
+
+    def one_request(rows):
+        start = time.time()
+        client.predict(images[rows])
+        return time.time() - start
+
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        latencies = np.array(list(executor.map(one_request, requests))) * 1000
+    seconds = time.time() - start
+    results = {
+        "requests": n_requests,
+        "concurrency": concurrency,
+        "images_per_request": images_per_request,
+        "p50_ms": float(np.percentile(latencies, 50)),
+        "p99_ms": float(np.percentile(latencies, 99)),
+        "requests_per_sec": n_requests / seconds,
+        "images_per_sec": n_requests * images_per_request / seconds,
+    }
+    print(
+        "p50 {p50_ms:.1f}ms  p99 {p99_ms:.1f}ms  {requests_per_sec:.1f} requests/s  "
+        "{images_per_sec:.1f} images/s".format(**results)
+    )
+    return results
+
+
+def _load_model(path):
+    if path.endswith(".tflite"):
+        from quantizer import TFLiteModel
+
+        return TFLiteModel(path)
+    from keras.models import load_model
+
+    return load_model(path)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--model", required=True, help="keras .h5 or .tflite model file")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--width", type=int, default=118)
+    parser.add_argument("--height", type=int, default=68)
+    parser.add_argument("--crop-to-ink", action="store_true")
+    parser.add_argument(
+        "--normalize",
+        action="store_true",
+        help="scale the images to [0, 1], for models without an input_rescale layer",
+    )
+    parser.add_argument("--max-batch-size", type=int, default=64)
+    parser.add_argument("--max-delay-ms", type=float, default=5)
+    args = parser.parse_args(argv)
+
+    service = PredictionService(
+        _load_model(args.model),
+        size=(args.width, args.height),
+        crop_to_ink=args.crop_to_ink,
+        normalize=args.normalize,
+        max_batch_size=args.max_batch_size,
+        max_delay_ms=args.max_delay_ms,
+    )
+    server = serve(service, args.host, args.port)
+    print("Serving on http://{}:{}".format(args.host, args.port))
+    try:
+        while True:
+            time.sleep(60)
+            print(json.dumps(service.stats.summary()))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
+        service.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,52 @@
+import time
+import multiprocessing
+
+
+def prefetch_shards(load_func, args_list, kwargs=None, prefetch=True):
+    """
+    Generator which loads shards one after the other with load_func, preparing shard i+1 in a
+    background process while the caller works on shard i. At most two shards are in flight at
+    once: the one that was handed out and the one being prepared
+
+    The background process is started with spawn rather than fork, since forking a process which
+    already holds a TensorFlow session is not safe
+
+    Arguments:
+        load_func - Module level function which loads a shard (e.g data_loader)
+        args_list - List of positional argument tuples, one per shard
+        kwargs - Keyword arguments passed to every call of load_func
+        prefetch - If false, shards are loaded in this process when they are needed
+
+    Yields:
+        i - Index of the shard in args_list
+        result - Whatever load_func returned for the shard
+        wait_time - Seconds spent waiting for the shard to be ready
+
+    """
+    kwargs = kwargs or {}
+
+    if not prefetch:
+        for i, args in enumerate(args_list):
+            start = time.time()
+            result = load_func(*args, **kwargs)
+            yield i, result, time.time() - start
+        return
+
+    ctx = multiprocessing.get_context("spawn")
+    pool = ctx.Pool(processes=1)
+    try:
+        pending = pool.apply_async(load_func, args_list[0], kwargs) if args_list else None
+        for i in range(len(args_list)):
+            start = time.time()
+            result = pending.get()
+            wait_time = time.time() - start
+
+            # queue up the next shard before handing this one out
+            if i + 1 < len(args_list):
+                pending = pool.apply_async(load_func, args_list[i + 1], kwargs)
+
+            yield i, result, wait_time
+            del result
+    finally:
+        pool.terminate()
+        pool.join()
@@ -0,0 +1,212 @@
+import time
+import numpy as np
+import tensorflow as tf
+from keras import backend as K
+
+# number of classes of each output, which is also how the outputs of a converted model are told apart
+OUTPUT_SIZES = {"output_root": 168, "output_vowel": 11, "output_consonant": 7}
+
+
+def calibration_sample(x, n_images=500, seed=42):
+    """
+    Picks a random sample of training images to calibrate the int8 quantization ranges with
+    """
+    rng = np.random.RandomState(seed)
+    rows = rng.choice(len(x), size=min(n_images, len(x)), replace=False)
+    return x[np.sort(rows)]
+
+
+def export_tflite(model, path, calibration_images=None, mode="int8"):
+    """
+    Converts a trained model_create network into a post-training quantized TFLite model
+
+    Arguments:
+        model - Trained keras model
+        path - Location of the .tflite file to write
+        calibration_images - Sample of training images (see calibration_sample), needed for int8
+        mode - "int8" for integer weights and activations, "float16" for half precision weights,
+            or "float32" for no quantization at all
+
+    Returns:
+        size - Size of the written model in bytes
+
+    """
+    if hasattr(tf.lite.TFLiteConverter, "from_session"):
+        # TensorFlow 1.x, where the keras model lives in the backend session. Its graph still
+        # switches the dropout and batch normalization layers on the learning phase, so the model
+        # is rebuilt with its trained weights in a graph of its own, fixed to inference
+        from keras.models import Model
+
+        config, weights = model.get_config(), model.get_weights()
+        graph = tf.Graph()
+        session = tf.compat.v1.Session(graph=graph)
+        with graph.as_default(), session.as_default():
+            # the learning phase is set per graph, the training graph is left alone
+            K.set_learning_phase(0)
+            inference_model = Model.from_config(config)
+            inference_model.set_weights(weights)
+            # the graph is frozen into the converter here, so the session isn't needed after
+            converter = tf.lite.TFLiteConverter.from_session(
+                session, inference_model.inputs, inference_model.outputs
+            )
+        session.close()
+    else:
+        converter = tf.lite.TFLiteConverter.from_keras_model(model)
+
+    if mode == "int8":
+        if calibration_images is None:
+            raise ValueError("int8 quantization needs calibration images")
+
+        def representative_dataset():
+            for image in calibration_images:
+                yield [image[np.newaxis].astype(np.float32)]
+
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.representative_dataset = representative_dataset
+    elif mode == "float16":
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.target_spec.supported_types = [tf.float16]
+    elif mode != "float32":
+        raise ValueError("Unknown quantization mode {}".format(mode))
+
+    tflite_model = converter.convert()
+    with open(path, "wb") as f:
+        f.write(tflite_model)
+    return len(tflite_model)
+
+
+class TFLiteModel:
+    """
+    Inference engine for a model written by export_tflite. Its predict method returns the same
+    [root, vowel, consonant] list of probabilities as the keras model, so it can be passed to
+    tester.test_func in place of the keras model
+
+    Arguments:
+        path - Location of the .tflite file
+        num_threads - Number of threads used by the interpreter, where supported
+
+    """
+
+    def __init__(self, path, num_threads=None):
+        try:
+            self.interpreter = tf.lite.Interpreter(model_path=path, num_threads=num_threads)
+        except TypeError:
+            # older versions of the interpreter don't take a number of threads
+            self.interpreter = tf.lite.Interpreter(model_path=path)
+        self.input_detail = self.interpreter.get_input_details()[0]
+        output_details = self.interpreter.get_output_details()
+        # lining the outputs up in the order of the keras model, by their number of classes
+        sizes = {detail["shape"][-1]: detail for detail in output_details}
+        self.output_details = [sizes[size] for size in OUTPUT_SIZES.values()]
+        self.batch_size = None
+
+    def _resize(self, batch_size):
+        if batch_size != self.batch_size:
+            shape = [batch_size] + list(self.input_detail["shape"][1:])
+            self.interpreter.resize_tensor_input(self.input_detail["index"], shape)
+            self.interpreter.allocate_tensors()
+            self.batch_size = batch_size
+
+    def predict(self, x, batch_size=256):
+        outputs = [
+            np.empty((len(x), detail["shape"][-1]), dtype=np.float32)
+            for detail in self.output_details
+        ]
+        input_dtype = self.input_detail["dtype"]
+        input_scale, input_zero_point = self.input_detail["quantization"]
+
+        for start in range(0, len(x), batch_size):
+            batch = x[start : start + batch_size]
+            self._resize(len(batch))
+            # models with integer inputs expect the images already quantized
+            if input_dtype in (np.int8, np.uint8) and input_scale:
+                batch = np.round(batch / input_scale + input_zero_point)
+            self.interpreter.set_tensor(
+                self.input_detail["index"], batch.astype(input_dtype)
+            )
+            self.interpreter.invoke()
+            for output, detail in zip(outputs, self.output_details):
+                values = self.interpreter.get_tensor(detail["index"])
+                scale, zero_point = detail["quantization"]
+                if detail["dtype"] in (np.int8, np.uint8) and scale:
+                    values = (values.astype(np.float32) - zero_point) * scale
+                output[start : start + len(batch)] = values
+        return outputs
+
+
+def compare_models(keras_model, tflite_model, x, y=None, batch_size=256):
+    """
+    Compares a quantized model against the float model it came from on the same images, printing and
+    returning the latency, throughput, agreement between the two models' predictions and, if
+    labels are given, the accuracy of each
+
+    Arguments:
+        keras_model - Float keras model
+        tflite_model - TFLiteModel converted from it
+        x - Images to predict on
+        y - Optional list of [root, vowel, consonant] integer labels
+        batch_size - Batch size used by both models
+
+    Returns:
+        report - Dictionary with a "float" and a "quantized" entry, the agreement per output and,
+            if labels are given, the change in accuracy per output
+
+    """
+    report = {"agreement": {}}
+    predictions = {}
+    for label, model in [("float", keras_model), ("quantized", tflite_model)]:
+        start = time.time()
+        preds = model.predict(x, batch_size=batch_size)
+        seconds = time.time() - start
+        predictions[label] = [np.argmax(p, axis=1) for p in preds]
+        report[label] = {
+            "seconds": seconds,
+            "images_per_sec": len(x) / seconds,
+            "ms_per_batch": 1000 * seconds / np.ceil(len(x) / batch_size),
+        }
+        if y is not None:
+            for output, pred, target in zip(OUTPUT_SIZES, predictions[label], y):
+                report[label][output + "_accuracy"] = float(np.mean(pred == target))
+
+    for output, float_pred, quantized_pred in zip(
+        OUTPUT_SIZES, predictions["float"], predictions["quantized"]
+    ):
+        report["agreement"][output] = float(np.mean(float_pred == quantized_pred))
+
+    if y is not None:
+        report["accuracy_delta"] = {
+            output: report["quantized"][output + "_accuracy"]
+            - report["float"][output + "_accuracy"]
+            for output in OUTPUT_SIZES
+        }
+
+    for label in ["float", "quantized"]:
+        print(
+            "{:<10} {:>10.1f} images/s {:>8.2f} ms/batch".format(
+                label, report[label]["images_per_sec"], report[label]["ms_per_batch"]
+            )
+        )
+        if y is not None:
+            print(
+                "{:<10} accuracy: ".format("")
+                + ", ".join(
+                    "{} {:.4f}".format(output, report[label][output + "_accuracy"])
+                    for output in OUTPUT_SIZES
+                )
+            )
+    print(
+        "agreement: "
+        + ", ".join(
+            "{} {:.4f}".format(output, value)
+            for output, value in report["agreement"].items()
+        )
+    )
+    if y is not None:
+        print(
+            "accuracy delta: "
+            + ", ".join(
+                "{} {:+.4f}".format(output, value)
+                for output, value in report["accuracy_delta"].items()
+            )
+        )
+    return report
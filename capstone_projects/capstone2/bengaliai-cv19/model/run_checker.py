@@ -1,170 +1,343 @@
 import os
 import re
+import json
 from collections import defaultdict
+import numpy as np
 import pandas as pd
 import yaml
 
 
+# default location of the mlruns folder
+MLRUNS_PATH = "/home/jayanth/Documents/springboard/capstone_projects/capstone2/bengaliai-cv19/mlruns"
+
+# compiled once here rather than for every file we look at
+EXP_PATTERN = re.compile(r"exp_(\d+)_.")
+
+
+# run statuses as mlflow writes them to the meta.yaml of each run
+RUN_STATUSES = {1: "RUNNING", 2: "SCHEDULED", 3: "FINISHED", 4: "FAILED", 5: "KILLED"}
+
+
+def _read_run_meta(meta_path):
+    """
+    Returns the status and start time (in ms) of a run from its meta.yaml, None for both if the
+    file isn't there
+    """
+    if not os.path.exists(meta_path):
+        return None, None
+    with open(meta_path) as f:
+        yaml_dict = yaml.safe_load(f) or {}
+    status = yaml_dict.get("status")
+    return RUN_STATUSES.get(status, status), yaml_dict.get("start_time")
+
+
+def _read_last_line(path, size):
+    """
+    Returns the byte offset and contents of the last line of a metric file. It seeks back from
+    the end of the file, so only the last line is read no matter how long the file is
+    """
+    # need to open in binary mode as file is not .txt
+    with open(path, "rb") as f_file:
+        # this bit of code comes from here : https://stackoverflow.com/questions/46258499/read-the-last-line-of-a-file-in-python
+        # it seeks out the end of the file and reads last line
+        offset = max(size - 2, 0)
+        f_file.seek(offset)
+        while offset > 0 and f_file.read(1) != b"\n":
+            offset -= 1
+            f_file.seek(offset)
+        if offset > 0:
+            offset += 1
+        f_file.seek(offset)
+        return offset, f_file.readline().decode().strip()
+
+
+def _scan_metrics(metrics_path, old_metrics):
+    metrics = {}
+    for entry in os.scandir(metrics_path):
+        if not entry.is_file():
+            continue
+        stat = entry.stat()
+        old = old_metrics.get(entry.name)
+        # files which haven't changed since the last scan are not opened at all
+        if old is not None and old["mtime"] == stat.st_mtime and old["size"] == stat.st_size:
+            metrics[entry.name] = old
+            continue
+        offset, last_line = _read_last_line(entry.path, stat.st_size)
+        metrics[entry.name] = {
+            "mtime": stat.st_mtime,
+            "size": stat.st_size,
+            "offset": offset,
+            "last_line": last_line,
+        }
+    return metrics
+
+
+def scan_mlruns(
+    filepath=MLRUNS_PATH,
+    index_file=None,
+):
+    """
+    This helper function builds an index of every run in the mlruns folder, with the experiment
+    number, status and start time of each run and, for each of its metric files, the modification
+    time, the byte offset of the last line and the last line itself
+
+    The index is saved to index_file (run_index.json inside the mlruns folder by default) and on the
+    next call only the meta.yaml and metric files which changed since are read again
+
+    Arguments:
+        filepath - Location of mlruns folder
+        index_file - Location of the saved index
+
+    Returns:
+        index - Dictionary with an "experiments" and a "runs" entry
+
+    """
+    if index_file is None:
+        index_file = os.path.join(filepath, "run_index.json")
+
+    old_index = {"experiments": {}, "runs": {}}
+    if os.path.exists(index_file):
+        try:
+            with open(index_file) as f:
+                old_index = json.load(f)
+        except ValueError:
+            # a corrupt index is simply rebuilt
+            pass
+
+    index = {"experiments": {}, "runs": {}}
+    for exp_entry in os.scandir(filepath):
+        # skipping files and mlflow's .trash folder
+        if not exp_entry.is_dir() or exp_entry.name.startswith("."):
+            continue
+        meta_path = os.path.join(exp_entry.path, "meta.yaml")
+        if not os.path.exists(meta_path):
+            continue
+
+        # the experiment number is read from the meta yaml file, unless it hasn't changed
+        meta_mtime = os.path.getmtime(meta_path)
+        experiment = old_index["experiments"].get(exp_entry.name)
+        if experiment is None or experiment["mtime"] != meta_mtime:
+            with open(meta_path) as f:
+                yaml_dict = yaml.safe_load(f) or {}
+            match = EXP_PATTERN.search(yaml_dict.get("name") or "")
+            experiment = {
+                "mtime": meta_mtime,
+                "name": yaml_dict.get("name"),
+                "experiment_number": match.group(1) if match else None,
+            }
+        index["experiments"][exp_entry.name] = experiment
+
+        for run_entry in os.scandir(exp_entry.path):
+            metrics_path = os.path.join(run_entry.path, "metrics")
+            if not run_entry.is_dir() or not os.path.isdir(metrics_path):
+                continue
+            old_run = old_index["runs"].get(run_entry.name, {})
+
+            # the status changes when the run ends, which rewrites its meta.yaml
+            run_meta_path = os.path.join(run_entry.path, "meta.yaml")
+            run_meta_mtime = (
+                os.path.getmtime(run_meta_path) if os.path.exists(run_meta_path) else None
+            )
+            if "status" in old_run and old_run.get("meta_mtime") == run_meta_mtime:
+                status, start_time = old_run["status"], old_run["start_time"]
+            else:
+                status, start_time = _read_run_meta(run_meta_path)
+
+            index["runs"][run_entry.name] = {
+                "experiment_id": exp_entry.name,
+                "experiment_number": experiment["experiment_number"],
+                "path": run_entry.path,
+                "meta_mtime": run_meta_mtime,
+                "status": status,
+                "start_time": start_time,
+                "metrics": _scan_metrics(metrics_path, old_run.get("metrics", {})),
+            }
+
+    if index != old_index:
+        # a truncated index would fail to parse on the next scan, so it replaces the old one
+        # in a single rename
+        with open(index_file + ".tmp", "w") as f:
+            json.dump(index, f)
+        os.replace(index_file + ".tmp", index_file)
+
+    return index
+
+
 def results_accumulator(
-    filepath="/home/jayanth/Documents/springboard/capstone_projects/capstone2/bengaliai-cv19/mlruns",
+    filepath=MLRUNS_PATH,
+    index_file=None,
 ):
     """
-    This helper function navigates all the folders from the different mlflow experiments and populates
+    This helper function goes through the index of the different mlflow experiments and populates
     a dictionary with the final training and validation accuracies in a dictionary, which is converted
     and returned as a dataframe
 
+    Only the most recent FINISHED run of each experiment number is used, so runs left over from
+    failed or crashed attempts (e.g. retried points of grid_scheduler.run_grid) don't shadow it
+
     Arguments:
         filepath - Location of mlruns folder
+        index_file - Location of the saved run index (see scan_mlruns)
 
     Returns:
         master_exp_df - A pandas dataframe with experiment numbers and accuracies
 
     """
+    index = scan_mlruns(filepath, index_file)
 
-    # first let's change the current working directory
-    os.chdir(filepath)
+    # picking the latest finished run of every experiment number
+    latest_runs = {}
+    for run in index["runs"].values():
+        exp_number = run["experiment_number"]
+        if exp_number is None or run["status"] != "FINISHED":
+            continue
+        latest = latest_runs.get(exp_number)
+        if latest is None or (run["start_time"] or 0) > (latest["start_time"] or 0):
+            latest_runs[exp_number] = run
 
     # let's initiate an empty dictionary
     master_exp_dict = defaultdict(dict)
 
-    # let's navigate through each of the subfolders and files within the mlruns folder
-    for root, _, files in os.walk(os.getcwd()):
-
-        for f in files:
-            # the experiment number must be read from the meta yaml file using regular expressions
-            if f == "meta.yaml":
-                os.chdir(root)
-                yaml_dict = yaml.load(open(f))
-                if yaml_dict["name"] != "":
-                    exp_pattern = re.compile(r"exp_(\d\d?)_.")
-                    matches = exp_pattern.finditer(yaml_dict["name"])
-                    for match in matches:
-                        exp_number = match.group(1)
-
-        # navigating into the metrics folder for each experiment
-        if root.endswith("metrics"):
-            os.chdir(root)
-            # moving into that directory
-            for f in files:
-                # iterating through list of files and opening only the ones which list accuracy
-                if f.endswith("accuracy"):
-                    fname = f
-                    # need to open in binary mode as file is not .txt
-                    with open(fname, "rb") as f_file:
-                        # this bit of code comes from here : https://stackoverflow.com/questions/46258499/read-the-last-line-of-a-file-in-python
-                        # it seeks out the end of the file and reads last line
-                        f_file.seek(-2, os.SEEK_END)
-                        while f_file.read(1) != b"\n":
-                            f_file.seek(-2, os.SEEK_CUR)
-                        last_line = f_file.readline().decode()
-                        acc_pattern = re.compile(r"0\.\d+")
-                        acc_matches = acc_pattern.finditer(last_line)
-                        # appending to our dictionary
-                        for match in acc_matches:
-                            master_exp_dict[exp_number][f] = match[0]
+    for exp_number, run in latest_runs.items():
+        for metric, info in run["metrics"].items():
+            # only the metrics which list accuracy, with the value taken from the last line
+            # (each line is "timestamp value step")
+            if metric.endswith("accuracy") and info["last_line"]:
+                master_exp_dict[exp_number][metric] = float(info["last_line"].split()[1])
+
     # converting dictionary to a dataframe
     master_exp_df = pd.DataFrame.from_dict(master_exp_dict, orient="index")
     master_exp_df.index.name = "experiment_number"
 
-    # also return back to original project path
-    os.chdir(
-        "/home/jayanth/Documents/springboard/capstone_projects/capstone2/bengaliai-cv19/"
-    )
     # aaaaand finally returning our dataframe
     return master_exp_df
 
 
-def metrics_trends(
-    model_number,
-    filepath="/home/jayanth/Documents/springboard/capstone_projects/capstone2/bengaliai-cv19/mlruns",
-    metrics_list=[
-        "output_root_accuracy",
-        "output_root_loss",
-        "val_output_root_accuracy",
-        "output_vowel_accuracy",
-        "output_vowel_loss",
-        "val_output_vowel_accuracy",
-        "output_consonant_accuracy",
-        "output_consonant_loss",
-        "val_output_consonant_accuracy",
-        "val_output_root_loss",
-        "val_output_vowel_loss",
-        "val_output_consonant_loss",
-    ],
+# metrics plotted by default, as written by mlflow.keras.autolog
+TREND_METRICS = [
+    "output_root_accuracy",
+    "output_root_loss",
+    "val_output_root_accuracy",
+    "output_vowel_accuracy",
+    "output_vowel_loss",
+    "val_output_vowel_accuracy",
+    "output_consonant_accuracy",
+    "output_consonant_loss",
+    "val_output_consonant_accuracy",
+    "val_output_root_loss",
+    "val_output_vowel_loss",
+    "val_output_consonant_loss",
+]
+
+
+def load_metrics_trends(
+    model_numbers,
+    filepath=MLRUNS_PATH,
+    metrics_list=TREND_METRICS,
+    index_file=None,
 ):
     """
-    This helper function navigates all the folders from the different mlflow experiments and populates
-    a dictionary with the trends of different metrics for each model number
+    This helper function loads the trends of different metrics for a list of model numbers in a
+    single pass over the run index. Each metric file is read in one go with pandas rather than
+    line by line
 
     Arguments:
+        model_numbers - List of model (experiment) numbers
         filepath - Location of mlruns folder
-        model_number - Model number
         metrics_list - List of metrics
+        index_file - Location of the saved run index (see scan_mlruns)
+
+    Returns:
+        trends - Long dataframe with one row per logged value and the columns experiment_number,
+            run_id, metric, position (line number in the metric file), step, timestamp and value
 
     """
+    index = scan_mlruns(filepath, index_file)
+    wanted_models = {int(number) for number in model_numbers}
+    wanted_metrics = set(metrics_list)
 
-    # first let's change the current working directory
-    os.chdir(filepath)
+    frames = []
+    for run_id, run in index["runs"].items():
+        if run["experiment_number"] is None:
+            continue
+        if int(run["experiment_number"]) not in wanted_models:
+            continue
+        for metric in run["metrics"]:
+            if metric not in wanted_metrics:
+                continue
+            # each line of a metric file is "timestamp value step"
+            metric_df = pd.read_csv(
+                os.path.join(run["path"], "metrics", metric),
+                sep=" ",
+                header=None,
+                names=["timestamp", "value", "step"],
+            )
+            metric_df["experiment_number"] = int(run["experiment_number"])
+            metric_df["run_id"] = run_id
+            metric_df["metric"] = metric
+            metric_df["position"] = np.arange(len(metric_df))
+            frames.append(metric_df)
 
-    # let's initiate an empty dictionary
-    trends_dict = defaultdict(dict)
-
-    time_flag = 0
-    time_list = []
-    # let's navigate through each of the subfolders and files within the mlruns folder
-    for root, _, files in os.walk(os.getcwd()):
-
-        for f in files:
-            # the experiment number must be read from the meta yaml file using regular expressions
-            if f == "meta.yaml":
-                os.chdir(root)
-                yaml_dict = yaml.load(open(f), Loader=yaml.FullLoader)
-                if yaml_dict["name"] != "":
-                    exp_pattern = re.compile(r"exp_(\d\d?)_.")
-                    matches = exp_pattern.finditer(yaml_dict["name"])
-                    for match in matches:
-                        exp_number = match.group(1)
-                        if int(exp_number) == model_number:
-                            name_pattern = re.compile(r"/mlruns/(\d\d?)")
-                            matches = name_pattern.finditer(root)
-                            for match in matches:
-                                folder_number = match.group(1)
+    columns = [
+        "experiment_number",
+        "run_id",
+        "metric",
+        "position",
+        "step",
+        "timestamp",
+        "value",
+    ]
+    if not frames:
+        return pd.DataFrame(columns=columns)
 
-        try:
-            if "mlruns/{}/".format(folder_number) in root:
-                if root.endswith("metrics"):
-                    os.chdir(root)
-                    for f in files:
-                        if f in metrics_list:
-                            with open(f, "rb") as f_file:
-                                accuracy = []
-
-                                for line in f_file:
-                                    acc_pattern = re.compile(r"\d\.\d+")
-
-                                    line = line.decode()
-                                    acc_matches = acc_pattern.finditer(line)
-
-                                    for acc_match in acc_matches:
-                                        accuracy.append(float(acc_match[0]))
-
-                                    if time_flag == 0:
-                                        time_pattern = re.compile(r"1586\d{9}")
-                                        time_matches = time_pattern.finditer(line)
-                                        for time_match in time_matches:
-                                            time_list.append(time_match[0])
-
-                                if time_flag == 0:
-                                    trends_dict["time"] = time_list
-                                    time_flag += 1
-                                trends_dict[f] = accuracy
-
-        except UnboundLocalError:
-            pass
+    trends = pd.concat(frames, ignore_index=True)[columns]
+    trends["timestamp"] = pd.to_datetime(trends["timestamp"], unit="ms")
+    return trends
+
+
+def pivot_trends(trends):
+    """
+    Turns the long trends of a single model (from load_metrics_trends) into the wide format of
+    metrics_trends: one column per metric, plus the time of each value and the seconds since the
+    first one. If the model has several runs, the most recent one is used
+
+    Arguments:
+        trends - Long dataframe from load_metrics_trends, filtered down to one model
 
-    df = pd.DataFrame.from_dict(trends_dict)
-    df["time"] = df["time"].astype(int)
-    df["time"] = pd.to_datetime(df["time"], unit="ms")
-    df["cumtime"] = pd.to_timedelta(df["time"] - df["time"][0]).astype("timedelta64[s]")
+    Returns:
+        df - Wide dataframe with one row per logged epoch, empty if nothing was logged yet
+
+    """
+    if trends.empty:
+        return pd.DataFrame(columns=["time", "cumtime"])
+
+    latest_run = trends.groupby("run_id")["timestamp"].max().idxmax()
+    trends = trends[trends["run_id"] == latest_run]
+
+    # epochs restart at 0 for every parquet file, so rows are lined up by their position in the file
+    df = trends.pivot(index="position", columns="metric", values="value")
+    df.columns.name = None
+    df["time"] = trends.groupby("position")["timestamp"].min()
+    df = df.reset_index(drop=True)
+    df["cumtime"] = (df["time"] - df["time"][0]).dt.total_seconds()
 
     return df
+
+
+def metrics_trends(
+    model_number,
+    filepath=MLRUNS_PATH,
+    metrics_list=TREND_METRICS,
+):
+    """
+    This helper function populates a dataframe with the trends of different metrics for a model number.
+    To load several models, load_metrics_trends does it in a single pass
+
+    Arguments:
+        filepath - Location of mlruns folder
+        model_number - Model number
+        metrics_list - List of metrics
+
+    """
+    trends = load_metrics_trends([model_number], filepath, metrics_list)
+    return pivot_trends(trends)
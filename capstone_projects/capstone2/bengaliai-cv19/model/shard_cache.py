@@ -0,0 +1,113 @@
+import os
+import json
+import shutil
+import hashlib
+import numpy as np
+
+
+def cache_key(key_dict):
+    """
+    Turns a dictionary of settings (source file, modification time, image size, ...) into
+    the name of the folder the cached arrays live in
+    """
+    key_string = json.dumps(key_dict, sort_keys=True)
+    return hashlib.sha1(key_string.encode()).hexdigest()
+
+
+def _entry_size(entry_path):
+    return sum(
+        entry.stat().st_size for entry in os.scandir(entry_path) if entry.is_file()
+    )
+
+
+def _touch(entry_path):
+    # the modification time of this marker file is what we use to find the least recently used entry
+    with open(os.path.join(entry_path, "last_used"), "a"):
+        pass
+    os.utime(os.path.join(entry_path, "last_used"), None)
+
+
+def _load_entry(entry_path):
+    arrays = {}
+    for entry in os.scandir(entry_path):
+        if entry.name.endswith(".npy"):
+            arrays[entry.name[:-4]] = np.load(entry.path, mmap_mode="r")
+    return arrays
+
+
+def evict(cache_dir, max_cache_bytes, keep=()):
+    """
+    Deletes the least recently used entries in cache_dir until the whole cache fits in
+    max_cache_bytes. Entries listed in keep are never deleted
+
+    Arguments:
+        cache_dir - Location of the cache
+        max_cache_bytes - Disk budget of the cache
+        keep - Names of entries which must not be evicted
+
+    """
+    entries = []
+    for entry in os.scandir(cache_dir):
+        # skipping half written entries from other processes
+        if not entry.is_dir() or entry.name.startswith("tmp_"):
+            continue
+        marker = os.path.join(entry.path, "last_used")
+        last_used = os.path.getmtime(marker) if os.path.exists(marker) else 0
+        entries.append((last_used, entry.name, _entry_size(entry.path)))
+
+    total = sum(size for _, _, size in entries)
+    for _, name, size in sorted(entries):
+        if total <= max_cache_bytes:
+            break
+        if name in keep:
+            continue
+        shutil.rmtree(os.path.join(cache_dir, name), ignore_errors=True)
+        total -= size
+
+
+def load_or_build(key_dict, build_func, cache_dir="./cache", max_cache_bytes=20 * 2 ** 30):
+    """
+    Returns the arrays stored for key_dict as read-only memory-mapped .npy files, building
+    them first if they are not in the cache yet. After building, least recently used entries
+    are evicted to keep the cache under max_cache_bytes
+
+    Arguments:
+        key_dict - Dictionary of everything the cached arrays depend on
+        build_func - Function which takes a folder path and saves the arrays into it as .npy files
+        cache_dir - Location of the cache
+        max_cache_bytes - Disk budget of the cache
+
+    Returns:
+        arrays - Dictionary of file name (without .npy) to memory-mapped array
+
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    name = cache_key(key_dict)
+    entry_path = os.path.join(cache_dir, name)
+
+    if not os.path.isdir(entry_path):
+        # the arrays are built in a tmp_ folder, which evict skips, and it only gets the name of
+        # the key once every array is written, so an interrupted build is never loaded
+        tmp_path = os.path.join(cache_dir, "tmp_{}_{}".format(name, os.getpid()))
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+        try:
+            build_func(tmp_path)
+            with open(os.path.join(tmp_path, "key.json"), "w") as f:
+                json.dump(key_dict, f, indent=2, sort_keys=True)
+        except BaseException:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            raise
+        try:
+            os.rename(tmp_path, entry_path)
+        except OSError:
+            # another process finished the same entry first, so we just use theirs
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            if not os.path.isdir(entry_path):
+                raise
+        _touch(entry_path)
+        evict(cache_dir, max_cache_bytes, keep=(name,))
+    else:
+        _touch(entry_path)
+
+    return _load_entry(entry_path)
@@ -0,0 +1,80 @@
+import os
+import numpy as np
+import pandas as pd
+from sklearn.model_selection import train_test_split
+
+
+def build_split_manifest(train_df, test_size=0.1, seed=42, stratify_on="grapheme_root"):
+    """
+    Splits every image of train.csv into training and validation once, stratified on a target so
+    each class keeps the same share of validation images. Using the same manifest for every
+    experiment makes their validation metrics comparable
+
+    Arguments:
+        train_df - Dataframe read from train.csv
+        test_size - Share of the images used for validation
+        seed - Seed of the split
+        stratify_on - Target column the split is stratified on
+
+    Returns:
+        manifest - Dataframe indexed by image_id with a boolean "validation" column
+
+    """
+    positions = np.arange(len(train_df))
+    _, val_positions = train_test_split(
+        positions,
+        test_size=test_size,
+        random_state=seed,
+        stratify=train_df[stratify_on].values,
+    )
+    validation = np.zeros(len(train_df), dtype=bool)
+    validation[val_positions] = True
+    return pd.DataFrame(
+        {"validation": validation}, index=pd.Index(train_df["image_id"], name="image_id")
+    )
+
+
+def save_split_manifest(manifest, path):
+    # experiments running at the same time may read the manifest while it is saved, so they
+    # only ever see the old file or the whole new one
+    manifest.astype(np.int8).to_csv(path + ".tmp")
+    os.replace(path + ".tmp", path)
+
+
+def load_split_manifest(path):
+    manifest = pd.read_csv(path, index_col="image_id")
+    return manifest.astype(bool)
+
+
+def load_or_build_split_manifest(
+    train_df, path="./split_manifest.csv", test_size=0.1, seed=42
+):
+    """
+    Loads the split manifest saved at path, or builds it from train.csv and saves it there.
+    Delete the file to draw a new split
+    """
+    if os.path.exists(path):
+        return load_split_manifest(path)
+    manifest = build_split_manifest(train_df, test_size=test_size, seed=seed)
+    save_split_manifest(manifest, path)
+    return manifest
+
+
+def split_rows(manifest, image_ids):
+    """
+    Looks up which images of a shard are used for training and which for validation
+
+    Arguments:
+        manifest - Split manifest from build_split_manifest
+        image_ids - Image ids of the shard, in the order of its rows
+
+    Returns:
+        train_rows, val_rows - Row numbers of the training and validation images of the shard
+
+    """
+    positions = manifest.index.get_indexer(image_ids)
+    if (positions < 0).any():
+        missing = np.asarray(image_ids)[positions < 0]
+        raise KeyError("Image ids {} are not in the split manifest".format(list(missing[:5])))
+    validation = manifest["validation"].values[positions]
+    return np.flatnonzero(~validation), np.flatnonzero(validation)
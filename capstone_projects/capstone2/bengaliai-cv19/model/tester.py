@@ -1,45 +1,130 @@
+import os
+import glob
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
 import numpy as np
+import pyarrow.parquet as pq
 from image_processor import image_processor_func
+from data_loader import iter_parquet_blocks
+from model_creator import check_input_scaling
 
 
-def test_func(model, name, normalize=True):
-    preds_dict = {"grapheme_root": [], "vowel_diacritic": [], "consonant_diacritic": []}
-
-    components = ["consonant_diacritic", "grapheme_root", "vowel_diacritic"]
-    target = []  # model predictions placeholder
-    row_id = []  # row_id place holder
-    for i in range(4):
-        df_test_img = pd.read_parquet("./data/test_image_data_{}.parquet".format(i))
-        df_test_img.set_index("image_id", inplace=True)
-
-        X_test = df_test_img.values.reshape(-1, 137, 236, 1)
-        X_test_resized = image_processor_func(X_test, resize=True, size=(118, 68))
-        X_test_resized = X_test_resized.values
-
-        if normalize:
-            # instead of loading all the data into memory and normalizing (faster but requires memory)
-            # we go through the data one at a time. this is slower but does not crash your computer
-            # by using up all your memory :)
-            for i in range(X_test_resized.shape[0]):
-                X_test_resized[i] = X_test_resized[i] / 255
-
-        X_test_resized = X_test_resized.reshape(-1, 118, 68, 1)
-        X_test_resized = X_test_resized.reshape(-1, 68, 118, 1)
-        preds = model.predict(X_test_resized)
-
-        for i, p in enumerate(preds_dict):
-            preds_dict[p] = np.argmax(preds[i], axis=1)
-
-        for k, id in enumerate(df_test_img.index.values):
-            for i, comp in enumerate(components):
-                id_sample = id + "_" + comp
-                row_id.append(id_sample)
-                target.append(preds_dict[comp][k])
-        del df_test_img
-        del X_test
-
-    df_sample = pd.DataFrame(
-        {"row_id": row_id, "target": target}, columns=["row_id", "target"]
-    )
-    df_sample.to_csv("submission_{}.csv".format(name), index=False)
+def _prepare_test_shard(
+    parquet_file_path, size, normalize, block_size, crop_to_ink, crop_padding
+):
+    """
+    Reads a test parquet file block by block and returns its image ids along with the
+    thresholded, resized images ready to be fed to the model
+    """
+    n_images = pq.ParquetFile(parquet_file_path).metadata.num_rows
+    image_ids = np.empty(n_images, dtype=object)
+    X_test = np.empty((n_images, size[0] * size[1]), dtype=np.uint8)
+
+    start = 0
+    for ids, pixels in iter_parquet_blocks(parquet_file_path, block_size):
+        stop = start + len(ids)
+        image_ids[start:stop] = ids
+        X_test[start:stop] = image_processor_func(
+            pixels,
+            resize=True,
+            size=size,
+            crop_to_ink=crop_to_ink,
+            crop_padding=crop_padding,
+        )
+        start = stop
+
+    if normalize:
+        X_test = np.multiply(X_test, 1 / 255, dtype=np.float32)
+
+    return image_ids.astype(str), X_test.reshape(-1, size[1], size[0], 1)
+
+
+def test_func(
+    model,
+    name,
+    normalize=False,
+    shard_glob="./data/test_image_data_*.parquet",
+    size=(118, 68),
+    block_size=4096,
+    crop_to_ink=False,
+    crop_padding=4,
+):
+    """
+    Runs inference on the test parquet files and writes the predictions to a submission csv.
+    The images are passed to the model as uint8, set normalize to true for models which
+    don't rescale their own inputs. Keras models are checked for their input_rescale layer, so a
+    model saved before rescale_input was added raises a ValueError unless normalize is true
+
+    The next parquet file is read and preprocessed in a background thread while the model predicts
+    on the current one, and the rows of each file are appended to the csv as soon as they are ready
+
+    Arguments:
+        model - Trained model (anything with a keras style predict method)
+        name - Name used for the submission_{name}.csv file
+        normalize - Scale the images to [0, 1] before prediction
+        shard_glob - Glob pattern matching the test parquet files
+        size - Size the images were resized to during training
+        block_size - Number of images read from a parquet file at a time
+        crop_to_ink, crop_padding - Crop settings the model was trained with (see
+            image_processor_func)
+
+    """
+    # row ids are written per image in this order, matching the sample submission
+    components = np.array(["consonant_diacritic", "grapheme_root", "vowel_diacritic"])
+    # ... while the model outputs are in this order
+    output_order = ["grapheme_root", "vowel_diacritic", "consonant_diacritic"]
+    component_positions = [output_order.index(comp) for comp in components]
+
+    check_input_scaling(model, normalize)
+
+    parquet_files = sorted(glob.glob(shard_glob))
+    if not parquet_files:
+        raise FileNotFoundError("No test files match {}".format(shard_glob))
+
+    submission_path = "submission_{}.csv".format(name)
+    if os.path.exists(submission_path):
+        os.remove(submission_path)
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        next_shard = executor.submit(
+            _prepare_test_shard,
+            parquet_files[0],
+            size,
+            normalize,
+            block_size,
+            crop_to_ink,
+            crop_padding,
+        )
+        for i in range(len(parquet_files)):
+            image_ids, X_test = next_shard.result()
+            # start on the next file before predicting on this one
+            if i + 1 < len(parquet_files):
+                next_shard = executor.submit(
+                    _prepare_test_shard,
+                    parquet_files[i + 1],
+                    size,
+                    normalize,
+                    block_size,
+                    crop_to_ink,
+                    crop_padding,
+                )
+
+            preds = model.predict(X_test)
+            # one column per component, in the row_id order
+            target = np.stack(
+                [np.argmax(preds[pos], axis=1) for pos in component_positions], axis=1
+            ).reshape(-1)
+
+            # every image id is repeated once per component and suffixed with it
+            row_id = np.char.add(
+                np.char.add(np.repeat(image_ids, len(components)), "_"),
+                np.tile(components, len(image_ids)),
+            )
+
+            df_sample = pd.DataFrame(
+                {"row_id": row_id, "target": target}, columns=["row_id", "target"]
+            )
+            df_sample.to_csv(
+                submission_path, mode="a", header=(i == 0), index=False,
+            )
+            del X_test, preds
@@ -0,0 +1,181 @@
+import itertools
+import numpy as np
+import tensorflow as tf
+from keras import backend as K
+
+# order of the outputs of model_create, which is also the order of the label columns
+OUTPUT_NAMES = ["output_root", "output_vowel", "output_consonant"]
+
+
+def _epoch_batches(shards, batch_size, shuffle, seed, epoch):
+    """
+    Yields the (images, labels) batches of one epoch. The training rows of every shard are
+    shuffled together, so each batch mixes images from all the shards
+    """
+    shard_ids = np.concatenate(
+        [np.full(len(rows), k, dtype=np.int32) for k, (_, _, rows) in enumerate(shards)]
+    )
+    shard_rows = np.concatenate([rows for _, _, rows in shards])
+    if shuffle:
+        order = np.random.RandomState([seed, epoch]).permutation(len(shard_rows))
+        shard_ids = shard_ids[order]
+        shard_rows = shard_rows[order]
+
+    image_shape = shards[0][0].shape[1:]
+    for start in range(0, len(shard_rows), batch_size):
+        batch_shards = shard_ids[start : start + batch_size]
+        batch_rows = shard_rows[start : start + batch_size]
+        images = np.empty((len(batch_rows),) + image_shape, dtype=np.uint8)
+        labels = np.empty((len(batch_rows), 3), dtype=np.int16)
+        for k in np.unique(batch_shards):
+            in_shard = batch_shards == k
+            x, y, _ = shards[k]
+            images[in_shard] = x[batch_rows[in_shard]]
+            labels[in_shard] = y[batch_rows[in_shard]]
+        yield images, labels
+
+
+def _projective_transform(images, transforms):
+    if hasattr(tf, "contrib"):
+        # TensorFlow 1.x
+        return tf.contrib.image.transform(images, transforms, interpolation="BILINEAR")
+    return tf.raw_ops.ImageProjectiveTransformV2(
+        images=images,
+        transforms=transforms,
+        output_shape=tf.shape(images)[1:3],
+        interpolation="BILINEAR",
+    )
+
+
+def _augment(images, rotation_range, width_shift_range, height_shift_range, seed):
+    """
+    Applies a random rotation and shift to every image of a batch, drawn like the ones of
+    MultiOutputSequence, as a single projective transform op
+    """
+    n = tf.shape(images)[0]
+    height = tf.cast(tf.shape(images)[1], tf.float32)
+    width = tf.cast(tf.shape(images)[2], tf.float32)
+    height_shift = height_shift_range
+    width_shift = width_shift_range
+    if height_shift < 1:
+        height_shift *= height
+    if width_shift < 1:
+        width_shift *= width
+
+    # each draw gets its own seed, draws with the same seed would come out identical
+    theta = tf.random.uniform([n], -rotation_range, rotation_range, seed=seed)
+    theta = theta * np.pi / 180
+    tx = tf.random.uniform([n], -height_shift, height_shift, seed=seed + 1)
+    ty = tf.random.uniform([n], -width_shift, width_shift, seed=seed + 2)
+    cos, sin = tf.cos(theta), tf.sin(theta)
+    # the same centre of rotation as keras' transform_matrix_offset_center
+    cx, cy = width / 2 + 0.5, height / 2 + 0.5
+    zeros = tf.zeros([n])
+    # maps every output pixel (x, y) back to the input pixel it is read from: a rotation about
+    # the centre of the image after a shift of tx rows and ty columns
+    transforms = tf.stack(
+        [
+            cos,
+            sin,
+            cx - cos * cx + cos * ty - sin * cy + sin * tx,
+            -sin,
+            cos,
+            cy - cos * cy + cos * tx + sin * cx - sin * ty,
+            zeros,
+            zeros,
+        ],
+        axis=1,
+    )
+    # the transform fills the pixels from outside the image with 0, which is ink here, so the
+    # images are inverted around it to fill them with background instead
+    inverted = 255.0 - tf.cast(images, tf.float32)
+    return 255.0 - _projective_transform(inverted, transforms)
+
+
+def make_dataset(
+    shards,
+    batch_size=32,
+    shuffle=True,
+    seed=None,
+    rotation_range=0,
+    width_shift_range=0.0,
+    height_shift_range=0.0,
+    num_parallel_calls=None,
+    prefetch_batches=None,
+    normalize=False,
+):
+    """
+    Builds an endless tf.data pipeline of training batches over several preprocessed shards.
+    Batches are gathered from the (memory-mapped) shards by a generator, augmented on
+    num_parallel_calls threads at once and prefetched, so the next batches are being built while
+    the model trains on the current one. Every epoch is reshuffled across all the shards
+
+    Arguments:
+        shards - List of (images, int16 targets, training rows) as returned by
+            data_loader.load_cached_split
+        batch_size - Number of images per batch
+        shuffle - Reshuffle the images at the start of each epoch
+        seed - Seed for shuffling and augmentation
+        rotation_range, width_shift_range, height_shift_range - Same meaning as in ImageDataGenerator
+        num_parallel_calls - Number of batches augmented at the same time, tuned by tf.data
+            by default
+        prefetch_batches - Number of batches built ahead, tuned by tf.data by default
+        normalize - Scale the images to [0, 1], for models created without rescale_input
+
+    Returns:
+        dataset - tf.data.Dataset of (images, dictionary of output name to targets) batches
+
+    """
+    seed = np.random.randint(2 ** 31 - 2) if seed is None else seed
+    autotune = tf.data.experimental.AUTOTUNE
+    epochs = itertools.count()
+
+    def generator():
+        # from_generator calls this again for every repetition of the dataset
+        return _epoch_batches(shards, batch_size, shuffle, seed, next(epochs))
+
+    image_shape = shards[0][0].shape[1:]
+    dataset = tf.data.Dataset.from_generator(
+        generator,
+        (tf.uint8, tf.int16),
+        (tf.TensorShape((None,) + image_shape), tf.TensorShape([None, 3])),
+    ).repeat()
+
+    augment = bool(rotation_range or width_shift_range or height_shift_range)
+
+    def to_outputs(images, labels):
+        if augment:
+            images = _augment(
+                images, rotation_range, width_shift_range, height_shift_range, seed
+            )
+        if normalize:
+            images = tf.cast(images, tf.float32) / 255.0
+        labels = tf.cast(labels, tf.int32)
+        return images, {name: labels[:, k] for k, name in enumerate(OUTPUT_NAMES)}
+
+    dataset = dataset.map(
+        to_outputs,
+        num_parallel_calls=autotune if num_parallel_calls is None else num_parallel_calls,
+    )
+    return dataset.prefetch(autotune if prefetch_batches is None else prefetch_batches)
+
+
+def steps_per_epoch(shards, batch_size):
+    return int(np.ceil(sum(len(rows) for _, _, rows in shards) / batch_size))
+
+
+def dataset_generator(dataset):
+    """
+    Turns a dataset into a python generator of numpy batches that fit_generator can train on,
+    through the keras session on TensorFlow 1.x. Use it with workers=0, the dataset already
+    builds its batches in the background
+    """
+    if tf.executing_eagerly():
+        for images, outputs in dataset:
+            yield images.numpy(), {name: value.numpy() for name, value in outputs.items()}
+        return
+
+    next_batch = tf.compat.v1.data.make_one_shot_iterator(dataset).get_next()
+    session = K.get_session()
+    while True:
+        yield session.run(next_batch)